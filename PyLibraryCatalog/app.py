@@ -1,4 +1,12 @@
 import os
+import re
+import json
+import time
+import atexit
+import sqlite3
+import threading
+from itertools import compress
+from collections import OrderedDict
 import requests
 from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file
 from werkzeug.utils import secure_filename
@@ -13,10 +21,159 @@ app.secret_key = "supersecretkey"
 COVER_FOLDER = os.path.join(app.root_path, 'static', 'covers')
 os.makedirs(COVER_FOLDER, exist_ok=True)
 
+# On-disk cache of Google Books lookups, so repeat ISBNs never hit the network
+ISBN_CACHE_PATH = os.path.join(app.root_path, 'isbn_cache.db')
+ISBN_CACHE_TTL = 30 * 24 * 3600
+ISBN_NEGATIVE_TTL = 24 * 3600
+ISBN_LRU_SIZE = 1024
+
+# The catalog lives in memory and is written back to this file a few seconds after a change
+CATALOG_SNAPSHOT_PATH = os.path.join(app.root_path, 'catalog_snapshot.json')
+CATALOG_SNAPSHOT_DELAY = 5
+
 # In-memory data storage (replace with DB in production)
 users = {"admin": {"password": "admin123", "approved": True}}
-books = []
-book_id_counter = 1
+
+# -------------------------------
+# Catalog store
+# -------------------------------
+
+class BookRecord:
+    """One catalog entry; __slots__ keeps it a fixed-size object instead of a per-book dict"""
+    __slots__ = ('id', 'title', 'authors', 'publisher', 'publishedDate', 'isbn', 'cover_url', 'in_library')
+
+    def __init__(self, id, title, authors, publisher, publishedDate, isbn, cover_url=None, in_library=True):
+        self.id = id
+        self.title = title
+        self.authors = authors
+        self.publisher = publisher
+        self.publishedDate = publishedDate
+        self.isbn = isbn
+        self.cover_url = cover_url
+        self.in_library = in_library
+
+    # Templates and exports index books like the dicts they used to be
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def as_row(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+class CatalogStore:
+    """Thread-safe in-memory catalog.
+
+    Records sit in insertion order in `_records`; `_by_id` and `_by_isbn` map to them directly,
+    and `_in_library` holds one byte per record so the In Library view is a single
+    itertools.compress() instead of a Python-level filter. Changes are snapshotted to disk
+    CATALOG_SNAPSHOT_DELAY seconds after they happen and on exit.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.RLock()
+        self._records = []
+        self._by_id = {}
+        self._by_isbn = {}
+        self._in_library = bytearray()
+        self._next_id = 1
+        self._dirty = False
+        self._timer = None
+
+    @staticmethod
+    def _isbn_key(isbn):
+        return normalize_isbn(isbn) or isbn
+
+    def add(self, title, authors, publisher, publishedDate, isbn, cover_url=None, in_library=True):
+        """Insert a book and return its record, or None if the ISBN is already in the catalog"""
+        with self._lock:
+            key = self._isbn_key(isbn)
+            if key in self._by_isbn:
+                return None
+            record = BookRecord(self._next_id, title, authors, publisher, publishedDate, isbn, cover_url, in_library)
+            self._next_id += 1
+            self._insert(record, key)
+            self._changed()
+            return record
+
+    def _insert(self, record, key):
+        self._by_id[record.id] = len(self._records)
+        self._by_isbn[key] = record
+        self._records.append(record)
+        self._in_library.append(1 if record.in_library else 0)
+
+    def get(self, book_id):
+        with self._lock:
+            slot = self._by_id.get(book_id)
+            return None if slot is None else self._records[slot]
+
+    def get_by_isbn(self, isbn):
+        with self._lock:
+            return self._by_isbn.get(isbn) or self._by_isbn.get(self._isbn_key(isbn))
+
+    def toggle_in_library(self, book_id):
+        """Flip a book's in_library flag; returns the new value, or None if there is no such book"""
+        with self._lock:
+            slot = self._by_id.get(book_id)
+            if slot is None:
+                return None
+            record = self._records[slot]
+            record.in_library = not record.in_library
+            self._in_library[slot] = 1 if record.in_library else 0
+            self._changed()
+            return record.in_library
+
+    def books(self, in_library_only=False):
+        with self._lock:
+            if in_library_only:
+                return list(compress(self._records, self._in_library))
+            return list(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def _changed(self):
+        # Coalesce bursts of changes into one snapshot
+        self._dirty = True
+        if self.path and self._timer is None:
+            self._timer = threading.Timer(CATALOG_SNAPSHOT_DELAY, self.save)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def save(self):
+        """Write the catalog to `path` atomically, if anything changed since the last save"""
+        with self._lock:
+            self._timer = None
+            if not self._dirty or not self.path:
+                return
+            data = {'next_id': self._next_id, 'columns': list(BookRecord.__slots__),
+                    'rows': [r.as_row() for r in self._records]}
+            self._dirty = False
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp, self.path)
+
+    def restore(self):
+        """Load the last snapshot from `path`; a missing file leaves the catalog empty"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            data = json.load(f)
+        # Reorder snapshot columns to the current slot order, so older snapshots still load
+        order = [data['columns'].index(name) if name in data['columns'] else None for name in BookRecord.__slots__]
+        with self._lock:
+            self._records, self._by_id, self._by_isbn = [], {}, {}
+            self._in_library = bytearray()
+            for row in data['rows']:
+                record = BookRecord(*[None if i is None else row[i] for i in order])
+                self._insert(record, self._isbn_key(record.isbn))
+            self._next_id = data['next_id']
+            self._dirty = False
+
+catalog = CatalogStore(CATALOG_SNAPSHOT_PATH)
 
 # -------------------------------
 # Helper functions
@@ -32,15 +189,78 @@ def current_user():
 def inject_user():
     return dict(current_user=current_user())
 
+def normalize_isbn(isbn):
+    """ISBN-13 form of an ISBN-10 or ISBN-13, or None if the checksum is wrong"""
+    isbn = re.sub(r'[^0-9Xx]', '', isbn or '').upper()
+    if re.fullmatch(r'\d{9}[\dX]', isbn):
+        if sum((10 - i) * (10 if ch == 'X' else int(ch)) for i, ch in enumerate(isbn)) % 11:
+            return None
+        isbn = '978' + isbn[:9]
+        return isbn + str(-sum((3 if i % 2 else 1) * int(ch) for i, ch in enumerate(isbn)) % 10)
+    if re.fullmatch(r'\d{13}', isbn) and not sum((3 if i % 2 else 1) * int(ch) for i, ch in enumerate(isbn)) % 10:
+        return isbn
+    return None
+
+_cache_lock = threading.Lock()
+_cache_lru = OrderedDict()
+_cache_db = None
+cache_stats = {'lru_hits': 0, 'disk_hits': 0, 'negative_hits': 0, 'misses': 0}
+
+def _cache_conn():
+    global _cache_db
+    if _cache_db is None:
+        _cache_db = sqlite3.connect(ISBN_CACHE_PATH, check_same_thread=False)
+        _cache_db.execute("CREATE TABLE IF NOT EXISTS isbn_cache (isbn13 TEXT PRIMARY KEY, data TEXT, fetched_at REAL NOT NULL)")
+    return _cache_db
+
+def cached_volume_info(isbn):
+    """Google Books volumeInfo for an ISBN (None if unknown), served from cache when fresh"""
+    key = normalize_isbn(isbn)
+    now = time.time()
+    if key:
+        with _cache_lock:
+            entry = _cache_lru.get(key)
+            if entry and entry[1] > now:
+                _cache_lru.move_to_end(key)
+                cache_stats['lru_hits'] += 1
+                if entry[0] is None:
+                    cache_stats['negative_hits'] += 1
+                return entry[0]
+            row = _cache_conn().execute("SELECT data, fetched_at FROM isbn_cache WHERE isbn13=?", (key,)).fetchone()
+            if row:
+                info = json.loads(row[0]) if row[0] else None
+                expires = row[1] + (ISBN_CACHE_TTL if info else ISBN_NEGATIVE_TTL)
+                if expires > now:
+                    cache_stats['disk_hits'] += 1
+                    if info is None:
+                        cache_stats['negative_hits'] += 1
+                    _cache_lru[key] = (info, expires)
+                    return info
+            cache_stats['misses'] += 1
+
+    res = requests.get("https://www.googleapis.com/books/v1/volumes", params={'q': f'isbn:{isbn}'}, timeout=10)
+    # Only a successful answer without items is cached as unknown; a 429 or 5xx raises before the cache is touched
+    res.raise_for_status()
+    data = res.json()
+    info = data['items'][0]['volumeInfo'] if 'items' in data else None
+
+    if key:
+        with _cache_lock:
+            conn = _cache_conn()
+            conn.execute("INSERT OR REPLACE INTO isbn_cache (isbn13, data, fetched_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(info) if info else None, now))
+            conn.commit()
+            _cache_lru[key] = (info, now + (ISBN_CACHE_TTL if info else ISBN_NEGATIVE_TTL))
+            while len(_cache_lru) > ISBN_LRU_SIZE:
+                _cache_lru.popitem(last=False)
+    return info
+
 def fetch_book_info(isbn):
     """Fetch book info and cover from Google Books API"""
-    url = f"https://www.googleapis.com/books/v1/volumes?q=isbn:{isbn}"
     try:
-        res = requests.get(url, timeout=10)
-        data = res.json()
-        if 'items' not in data:
+        info = cached_volume_info(isbn)
+        if info is None:
             return None
-        info = data['items'][0]['volumeInfo']
         book = {
             'title': info.get('title', 'Unknown Title'),
             'authors': ", ".join(info.get('authors', [])) if 'authors' in info else "Unknown",
@@ -57,11 +277,14 @@ def fetch_book_info(isbn):
             filename = f"{isbn}{ext}"
             path = os.path.join(COVER_FOLDER, filename)
             try:
-                r = requests.get(img_url, timeout=10)
-                if r.status_code == 200:
-                    with open(path, 'wb') as f:
-                        f.write(r.content)
+                if os.path.exists(path):
                     book['cover_url'] = url_for('static', filename=f'covers/{filename}')
+                else:
+                    r = requests.get(img_url, timeout=10)
+                    if r.status_code == 200:
+                        with open(path, 'wb') as f:
+                            f.write(r.content)
+                        book['cover_url'] = url_for('static', filename=f'covers/{filename}')
             except Exception as e:
                 print("Error downloading cover:", e)
         return book
@@ -75,35 +298,33 @@ def fetch_book_info(isbn):
 
 @app.route("/", methods=["GET", "POST"])
 def index():
-    global book_id_counter
     if not current_user():
         return redirect(url_for("login"))
 
     if request.method == "POST":
         isbn = request.form.get("isbn")
         if isbn:
+            if catalog.get_by_isbn(isbn):
+                flash("Book already exists", "warning")
+                return redirect(url_for("index"))
             book = fetch_book_info(isbn)
-            if book:
-                book['id'] = book_id_counter
-                book_id_counter += 1
-                books.append(book)
+            if book and catalog.add(**book):
                 flash("Book added successfully!", "success")
+            elif book:
+                flash("Book already exists", "warning")
             else:
                 flash("Could not find book info for ISBN.", "danger")
         return redirect(url_for("index"))
 
     in_library = request.args.get('in_library')
     filter_in_library = bool(in_library)
-    filtered_books = [b for b in books if b['in_library']] if filter_in_library else books
-    return render_template("index.html", books=filtered_books, filter_in_library=filter_in_library)
+    return render_template("index.html", books=catalog.books(filter_in_library), filter_in_library=filter_in_library)
 
 @app.route("/toggle_in_library/<int:book_id>", methods=["POST"])
 def toggle_in_library(book_id):
-    for b in books:
-        if b['id'] == book_id:
-            b['in_library'] = not b['in_library']
-            return jsonify(success=True)
-    return jsonify(success=False, message="Book not found")
+    if catalog.toggle_in_library(book_id) is None:
+        return jsonify(success=False, message="Book not found")
+    return jsonify(success=True)
 
 # -------------------------------
 # User management
@@ -163,7 +384,7 @@ def export_csv():
     si = BytesIO()
     writer = csv.writer(si)
     writer.writerow(["Title", "Authors", "Publisher", "Published", "ISBN", "In Library"])
-    for b in books:
+    for b in catalog.books():
         writer.writerow([b['title'], b['authors'], b['publisher'], b['publishedDate'], b['isbn'], b['in_library']])
     si.seek(0)
     return send_file(si, mimetype="text/csv", download_name="library.csv", as_attachment=True)
@@ -180,7 +401,7 @@ def export_pdf():
     pdf.cell(0, 10, "Library", ln=True, align="C")
     pdf.ln(10)
 
-    for b in books:
+    for b in catalog.books():
         pdf.set_font("Arial", "B", 12)
         pdf.cell(0, 6, b['title'], ln=True)
         pdf.set_font("Arial", "", 11)
@@ -203,6 +424,9 @@ def export_pdf():
     pdf_output.seek(0)
     return send_file(pdf_output, mimetype="application/pdf", download_name="library.pdf", as_attachment=True)
 
+catalog.restore()
+atexit.register(catalog.save)
+
 # -------------------------------
 # Run app
 # -------------------------------
@@ -0,0 +1,142 @@
+"""Microbenchmark for the v1 in-memory catalog: the old list of dicts vs CatalogStore.
+
+Run from this directory, e.g.:
+
+    python3 bench.py --sizes 1k,10k,100k --ops 2000
+
+Prints one JSON document to stdout with per-operation timings and memory per book.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_size(text):
+    text = text.lower()
+    scale = {'k': 1000, 'm': 1000000}.get(text[-1], 1)
+    return int(float(text.rstrip('km')) * scale)
+
+
+def make_isbn13(n):
+    isbn = f"978{n:09d}"
+    return isbn + str(-sum((3 if i % 2 else 1) * int(ch) for i, ch in enumerate(isbn)) % 10)
+
+
+def make_book(n):
+    return {'title': f'Title {n}', 'authors': f'Author {n % 997}', 'publisher': 'Publisher',
+            'publishedDate': str(1900 + n % 120), 'isbn': make_isbn13(n), 'in_library': n % 3 != 0}
+
+
+def build_list(size):
+    books = []
+    for n in range(size):
+        book = make_book(n)
+        book['id'] = n + 1
+        books.append(book)
+    return books
+
+
+def build_store(app, size, path=None):
+    store = app.CatalogStore(path)
+    for n in range(size):
+        store.add(**make_book(n))
+    return store
+
+
+def timed(fn, ops):
+    start = time.perf_counter()
+    for _ in range(ops):
+        fn()
+    return round((time.perf_counter() - start) / ops * 1e6, 3)
+
+
+def bytes_per_book(build, size):
+    tracemalloc.start()
+    data = build(size)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+    return round(used / size, 1)
+
+
+def bench_size(app, size, ops):
+    books = build_list(size)
+    store = build_store(app, size)
+    ids = [random.randint(1, size) for _ in range(ops)]
+    isbns = [make_isbn13(i - 1) for i in ids]
+    id_iter, isbn_iter = iter(ids * 2), iter(isbns * 2)
+
+    def list_toggle():
+        book_id = next(id_iter)
+        for b in books:
+            if b['id'] == book_id:
+                b['in_library'] = not b['in_library']
+                return
+
+    def list_isbn():
+        isbn = next(isbn_iter)
+        return next((b for b in books if b['isbn'] == isbn), None)
+
+    # Linear scans are slow enough that a handful of iterations is plenty
+    scan_ops = max(10, min(ops, 2000000 // size))
+    result = {
+        'list_us': {
+            'toggle': timed(list_toggle, scan_ops),
+            'isbn_lookup': timed(list_isbn, scan_ops),
+            'filter_in_library': timed(lambda: [b for b in books if b['in_library']], scan_ops),
+        },
+        'store_us': {},
+        'bytes_per_book': {
+            'list': bytes_per_book(build_list, size),
+            'store': bytes_per_book(lambda n: build_store(app, n), size),
+        },
+    }
+    id_iter, isbn_iter = iter(ids * 2), iter(isbns * 2)
+    result['store_us'] = {
+        'toggle': timed(lambda: store.toggle_in_library(next(id_iter)), ops),
+        'isbn_lookup': timed(lambda: store.get_by_isbn(next(isbn_iter)), ops),
+        'filter_in_library': timed(lambda: store.books(True), scan_ops),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'catalog_snapshot.json')
+        store.path = path
+        store._dirty = True
+        start = time.perf_counter()
+        store.save()
+        saved = time.perf_counter()
+        app.CatalogStore(path).restore()
+        result['snapshot_ms'] = {
+            'save': round((saved - start) * 1000, 1),
+            'restore': round((time.perf_counter() - saved) * 1000, 1),
+            'file_kb': round(os.path.getsize(path) / 1024, 1),
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1k,10k,100k")
+    parser.add_argument("--ops", type=int, default=2000)
+    args = parser.parse_args()
+
+    # Detach the app's own catalog so nothing here writes its snapshot
+    sys.path.insert(0, HERE)
+    import app
+    app.catalog.path = None
+
+    random.seed(1)
+    results = {size: bench_size(app, parse_size(size), args.ops) for size in args.sizes.split(',')}
+    json.dump({'scenario': 'catalog_store', 'ops': args.ops, 'sizes': results}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,26 @@
 import sqlite3
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file
-import requests
+import re
+import json
+import asyncio
+import base64
+import queue
+import threading
+import time
+import uuid
+import zlib
+import hashlib
+import heapq
+import secrets
+import sys
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file, g, Response, stream_with_context, make_response
+from flask.sessions import SecureCookieSession, SessionInterface
 import os
 import csv
-from io import BytesIO
-from fpdf import FPDF
-import pyotp
-import qrcode
+from io import BytesIO, StringIO
+from markupsafe import Markup
 from werkzeug.security import generate_password_hash, check_password_hash
 
 app = Flask(__name__)
@@ -14,17 +28,387 @@ app.secret_key = 'your_secret_key'
 
 DB_PATH = 'library.db'
 COVERS_DIR = 'static/covers'
-os.makedirs(COVERS_DIR, exist_ok=True)
+COVER_VARIANTS_DIR = os.path.join(COVERS_DIR, 'variants')
+EXPORTS_DIR = 'exports'
+
+app.config.setdefault('DATABASE', DB_PATH)
+DB_POOL_SIZE = 16
+DB_BUSY_TIMEOUT_MS = 5000
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_STATEMENT_CACHE = 256
+
+GOOGLE_BOOKS_URL = os.environ.get('GOOGLE_BOOKS_URL', 'https://www.googleapis.com/books/v1/volumes')
+HTTP_TIMEOUT = 10
+IMPORT_WORKERS = 8
+IMPORT_PROGRESS_INTERVAL = 0.5
+BATCH_ADD_MAX = 100
+ISBN_CACHE_TTL = 30 * 24 * 3600
+ISBN_NEGATIVE_TTL = 24 * 3600
+ISBN_LRU_SIZE = 4096
+JOB_WORKERS = 4
+JOB_MAX_ATTEMPTS = 5
+JOB_BACKOFF_BASE = 2
+JOB_POLL_INTERVAL = 1.0
+JOB_LEASE = 300
+JOB_RETENTION = 7 * 24 * 3600
+TOMBSTONE_RETENTION = 90 * 24 * 3600
+# ASGI mode (asgi.py) runs enrichment jobs and import lookups on an asyncio loop with httpx,
+# up to ASYNC_LOOKUPS in flight per process, instead of a thread per lookup
+app.config.setdefault('ASYNC_JOBS', False)
+ASYNC_LOOKUPS = 256
+# Covers are resized once at ingest; (width, height) bounding boxes per size
+COVER_SIZES = {'thumb': (160, 240), 'medium': (400, 600)}
+COVER_FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 75, 'method': 4}),
+    'jpg': ('JPEG', 'image/jpeg', {'quality': 80, 'optimize': True, 'progressive': True}),
+}
+COVER_MAX_AGE = 30 * 24 * 3600
+ALL_OWNERS = 0
+PAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# Public snapshots hold an owner's whole catalog as HTML and JSON, so the cache is capped by size
+PUBLIC_SNAPSHOT_MAX_BYTES = 64 * 1024 * 1024
+PUBLIC_BUILD_LOCKS = 64
+PUBLIC_MAX_AGE = 60
+PUBLIC_PATH_PREFIX = '/u/'
+# werkzeug hash spec, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000"; stored hashes made
+# with other parameters are upgraded on the user's next successful login
+app.config.setdefault('PASSWORD_HASH_METHOD', os.environ.get('CATALOG_PASSWORD_HASH', 'scrypt:32768:8:1'))
+# Login attempts are throttled per client IP and per username before any hashing happens
+app.config.setdefault('LOGIN_RATE_LIMIT', os.environ.get('CATALOG_LOGIN_RATE_LIMIT', '1') != '0')
+LOGIN_IP_BURST = 10
+LOGIN_IP_PER_MINUTE = 10
+LOGIN_USER_BURST = 5
+LOGIN_USER_PER_MINUTE = 5
+LOGIN_BUCKETS = 100000
+# Server-side sessions: rows in SQLite with an LRU of recently used ones in front. Other
+# processes notice a revoked session within SESSION_CACHE_TTL; this one immediately.
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 5
+ANON_SESSION_LIFETIME = 3600
+# A signed-in session that isn't permanent gets a cookie that ends with the browser; its row
+# can't see that happen, so it is kept this long instead of PERMANENT_SESSION_LIFETIME
+BROWSER_SESSION_LIFETIME = 24 * 3600
+# Instrumentation is off unless CATALOG_METRICS=1; the profiler additionally needs a threshold
+app.config.setdefault('METRICS', os.environ.get('CATALOG_METRICS') == '1')
+app.config.setdefault('PROFILE_SLOW_MS', int(os.environ.get('CATALOG_PROFILE_SLOW_MS', '0')))
+PROFILES_DIR = 'profiles'
+PROFILE_INTERVAL = 0.005
 
 # ---------------- Database -----------------
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+def connect_db(path):
+    # Connections move between request threads but are only used by one at a time
+    factory = InstrumentedConnection if app.config['METRICS'] else sqlite3.Connection
+    conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                           cached_statements=DB_STATEMENT_CACHE, factory=factory)
     conn.row_factory = sqlite3.Row
+    # WAL lets readers run alongside a writer instead of failing with "database is locked"
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA foreign_keys=ON")
     return conn
 
-def init_db():
-    conn = get_db()
-    c = conn.cursor()
+class ConnectionPool:
+    # Keeps up to `size` idle connections; each one carries its own prepared-statement cache,
+    # so reusing connections also reuses compiled statements across requests.
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect_db(self.path)
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._idle.qsize() < self.size:
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(path=None):
+    path = path or app.config['DATABASE']
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = ConnectionPool(path)
+            conn = pool.acquire()
+            try:
+                check_schema(conn)
+            finally:
+                pool.release(conn)
+            _pools[path] = pool
+        return pool
+
+def get_db():
+    # One pooled connection per app context, handed back in close_db()
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().release(conn)
+
+def execute_script(c, script):
+    # Like executescript() but without its implicit COMMIT, so it can run inside a migration
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            c.execute(statement)
+            statement = ''
+
+# ---------------- Instrumentation -----------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LOOKUP_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 500)
+METRIC_HELP = {
+    'catalog_http_request_duration_seconds': ('histogram', 'Request latency by endpoint'),
+    'catalog_http_requests_total': ('counter', 'Requests by endpoint and status'),
+    'catalog_sql_queries_per_request': ('histogram', 'SQL statements executed per request'),
+    'catalog_sql_seconds_per_request': ('histogram', 'Time spent in SQL per request'),
+    'catalog_sql_queries_total': ('counter', 'SQL statements executed, including background jobs'),
+    'catalog_sql_seconds_total': ('counter', 'Time spent in SQL, including background jobs'),
+    'catalog_http_client_duration_seconds': ('histogram', 'Outbound HTTP latency to response headers'),
+    'catalog_isbn_cache_events_total': ('counter', 'ISBN lookups by cache outcome'),
+    'catalog_page_cache_events_total': ('counter', 'Catalog page renders by cache outcome'),
+    'catalog_login_attempts_total': ('counter', 'Login attempts by outcome'),
+    'catalog_session_lookup_seconds': ('histogram', 'Session lookups by where they were answered'),
+    'catalog_sessions': ('gauge', 'Live sessions in the cache and in the database'),
+    'catalog_slow_request_profiles_total': ('counter', 'Slow requests written to the profiles directory'),
+}
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+_metrics_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_request_local = threading.local()
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = Histogram(buckets)
+        hist.observe(value)
+
+def count(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def render_metrics(gauges=None):
+    # Prometheus text exposition format 0.0.4; gauges are {(name, labels): value} sampled by the caller
+    with _metrics_lock:
+        histograms = {k: (h.buckets, list(h.counts), h.sum, h.count) for k, h in _histograms.items()}
+        counters = dict(_counters)
+    counters.update(gauges or {})
+    for kind, value in isbn_cache_counts().items():
+        counters[('catalog_isbn_cache_events_total', (('kind', kind),))] = value
+    for kind, value in page_cache.stats().items():
+        counters[('catalog_page_cache_events_total', (('kind', kind),))] = value
+    lines = []
+    for name, (kind, help_text) in METRIC_HELP.items():
+        series = histograms if kind == 'histogram' else counters
+        keys = sorted(k for k in series if k[0] == name)
+        if not keys:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key in keys:
+            labels = key[1]
+            if kind != 'histogram':
+                lines.append(f"{name}{format_labels(labels)} {series[key]}")
+                continue
+            buckets, counts, total, n = series[key]
+            cumulative = 0
+            for bound, c in zip(buckets, counts):
+                cumulative += c
+                lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {n}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {n}")
+    return '\n'.join(lines) + '\n'
+
+def record_sql(elapsed):
+    count('catalog_sql_queries_total')
+    count('catalog_sql_seconds_total', elapsed)
+    stats = getattr(_request_local, 'sql', None)
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += elapsed
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Times execute() up to the first row; rows fetched later are not counted
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_sql(time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_sql(time.perf_counter() - start)
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def record_http_client(resp, *args, **kwargs):
+    # requests response hook; elapsed covers connect + time to response headers
+    observe('catalog_http_client_duration_seconds', resp.elapsed.total_seconds(),
+            host=resp.url.split('/')[2] if '://' in resp.url else '', status=resp.status_code)
+
+async def start_http_client_timer(request):
+    # httpx request hook; its response hooks run before the body is read, when
+    # Response.elapsed isn't set yet, so the start time travels with the request
+    request.extensions['catalog_started'] = time.perf_counter()
+
+async def record_http_client_async(resp):
+    # httpx response hook: the same metric as record_http_client, up to response headers
+    observe('catalog_http_client_duration_seconds',
+            time.perf_counter() - resp.request.extensions['catalog_started'],
+            host=resp.url.netloc.decode('ascii'), status=resp.status_code)
+
+# Sampling profiler: while a request is in flight its thread's stack is sampled every
+# PROFILE_INTERVAL; requests slower than PROFILE_SLOW_MS are written out as collapsed
+# stacks ("frame;frame;frame count"), which flamegraph.pl and speedscope read directly.
+_profiled = {}
+_profiler_lock = threading.Lock()
+_profiler_started = False
+
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def profiler_loop():
+    while True:
+        time.sleep(PROFILE_INTERVAL)
+        with _profiler_lock:
+            active = list(_profiled.items())
+        if not active:
+            continue
+        frames = sys._current_frames()
+        for thread_id, samples in active:
+            frame = frames.get(thread_id)
+            if frame is not None:
+                samples[collapse_stack(frame)] += 1
+        # Holding on to frames across the sleep would keep their locals (open cursors) alive
+        del frames, frame
+
+def start_profiler():
+    global _profiler_started
+    with _profiler_lock:
+        if _profiler_started:
+            return
+        _profiler_started = True
+    threading.Thread(target=profiler_loop, daemon=True).start()
+
+def write_profile(endpoint, elapsed_ms, samples):
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{int(elapsed_ms)}ms-{uuid.uuid4().hex[:6]}.folded"
+    with open(os.path.join(PROFILES_DIR, name), 'w') as f:
+        for stack, n in samples.most_common():
+            f.write(f"{stack} {n}\n")
+    count('catalog_slow_request_profiles_total', endpoint=endpoint)
+
+@app.before_request
+def start_request_metrics():
+    if not app.config['METRICS']:
+        return
+    _request_local.start = time.perf_counter()
+    _request_local.sql = [0, 0.0]
+    if app.config['PROFILE_SLOW_MS']:
+        start_profiler()
+        with _profiler_lock:
+            _profiled[threading.get_ident()] = Counter()
+
+@app.after_request
+def record_request_metrics(response):
+    start = getattr(_request_local, 'start', None)
+    if start is None:
+        return response
+    # Streamed bodies (CSV export) are timed to the first byte, not to the last
+    elapsed = time.perf_counter() - start
+    endpoint = request.endpoint or 'unmatched'
+    observe('catalog_http_request_duration_seconds', elapsed, endpoint=endpoint, method=request.method)
+    count('catalog_http_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+    queries, sql_seconds = _request_local.sql
+    observe('catalog_sql_queries_per_request', queries, QUERY_COUNT_BUCKETS, endpoint=endpoint)
+    observe('catalog_sql_seconds_per_request', sql_seconds, endpoint=endpoint)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    start = getattr(_request_local, 'start', None)
+    _request_local.start = _request_local.sql = None
+    if start is None:
+        return
+    with _profiler_lock:
+        samples = _profiled.pop(threading.get_ident(), None)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if samples and elapsed_ms >= app.config['PROFILE_SLOW_MS']:
+        write_profile(request.endpoint or 'unmatched', elapsed_ms, samples)
+
+# ---------------- Migrations -----------------
+# Each migration runs once, in its own transaction, and PRAGMA user_version records the last
+# one applied. Append new migrations to MIGRATIONS; never edit one that has shipped.
+def migration_1_baseline(c):
+    # The schema init_db() used to create; everything is IF NOT EXISTS so older databases pass through
     c.execute('''CREATE TABLE IF NOT EXISTS users (
                     id INTEGER PRIMARY KEY,
                     username TEXT UNIQUE,
@@ -43,25 +427,1280 @@ def init_db():
                     in_library INTEGER DEFAULT 1,
                     owner TEXT
                 )''')
-    # Default admin
-    c.execute("SELECT * FROM users WHERE username='admin'")
-    if not c.fetchone():
-        c.execute("INSERT INTO users (username, password, approved) VALUES (?, ?, ?)",
-                  ('admin', generate_password_hash('admin123'), 1))
+    # Full-text index over the searchable book fields, kept in sync by triggers
+    fts_exists = c.execute("SELECT 1 FROM sqlite_master WHERE name='books_fts'").fetchone()
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+                    title, authors, publisher, isbn,
+                    content='books', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                )''')
+    execute_script(c, '''
+        CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts(rowid, title, authors, publisher, isbn)
+            VALUES (new.id, new.title, new.authors, new.publisher, new.isbn);
+        END;
+        CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts(books_fts, rowid, title, authors, publisher, isbn)
+            VALUES ('delete', old.id, old.title, old.authors, old.publisher, old.isbn);
+        END;
+        CREATE TRIGGER IF NOT EXISTS books_fts_au AFTER UPDATE OF title, authors, publisher, isbn ON books BEGIN
+            INSERT INTO books_fts(books_fts, rowid, title, authors, publisher, isbn)
+            VALUES ('delete', old.id, old.title, old.authors, old.publisher, old.isbn);
+            INSERT INTO books_fts(rowid, title, authors, publisher, isbn)
+            VALUES (new.id, new.title, new.authors, new.publisher, new.isbn);
+        END;
+    ''')
+    if not fts_exists:
+        # Index rows that predate the FTS table
+        c.execute("INSERT INTO books_fts(books_fts) VALUES ('rebuild')")
+    # Per-owner change counter ('' counts every owner), bumped on any change to their books
+    c.execute('''CREATE TABLE IF NOT EXISTS catalog_versions (
+                    owner TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL
+                )''')
+    execute_script(c, '''
+        CREATE TRIGGER IF NOT EXISTS books_version_ai AFTER INSERT ON books BEGIN
+            INSERT INTO catalog_versions(owner, version) VALUES (new.owner, 1), ('', 1)
+            ON CONFLICT(owner) DO UPDATE SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS books_version_ad AFTER DELETE ON books BEGIN
+            INSERT INTO catalog_versions(owner, version) VALUES (old.owner, 1), ('', 1)
+            ON CONFLICT(owner) DO UPDATE SET version = version + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS books_version_au AFTER UPDATE ON books BEGIN
+            INSERT INTO catalog_versions(owner, version) VALUES (old.owner, 1), ('', 1)
+            ON CONFLICT(owner) DO UPDATE SET version = version + 1;
+            INSERT INTO catalog_versions(owner, version) SELECT new.owner, 1 WHERE new.owner IS NOT old.owner
+            ON CONFLICT(owner) DO UPDATE SET version = version + 1;
+        END;
+    ''')
+    # Background jobs; persisted so queued work survives a restart
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    book_id INTEGER,
+                    owner TEXT,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    run_after REAL NOT NULL,
+                    last_error TEXT,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(state, run_after)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_book ON jobs(book_id)")
+    # Google Books lookups keyed by ISBN-13; data is NULL for ISBNs Google doesn't know
+    c.execute('''CREATE TABLE IF NOT EXISTS isbn_cache (
+                    isbn13 TEXT PRIMARY KEY,
+                    data TEXT,
+                    fetched_at REAL NOT NULL
+                )''')
+
+def migration_2_owner_id_isbn13(c):
+    # books.owner (username) becomes owner_id -> users.id, and gains a normalized isbn13.
+    # SQLite can't add a foreign key in place, so the table is rebuilt; ids are preserved,
+    # which keeps the external-content FTS index valid.
+    c.execute('''CREATE TABLE books_new (
+                    id INTEGER PRIMARY KEY,
+                    title TEXT,
+                    authors TEXT,
+                    publisher TEXT,
+                    publishedDate TEXT,
+                    isbn TEXT UNIQUE,
+                    isbn13 TEXT,
+                    cover_url TEXT,
+                    in_library INTEGER DEFAULT 1,
+                    owner_id INTEGER REFERENCES users(id) ON DELETE SET NULL
+                )''')
+    c.execute('''INSERT INTO books_new (id, title, authors, publisher, publishedDate, isbn, cover_url, in_library, owner_id)
+                 SELECT b.id, b.title, b.authors, b.publisher, b.publishedDate, b.isbn, b.cover_url, b.in_library, u.id
+                 FROM books b LEFT JOIN users u ON u.username = b.owner''')
+    c.execute("DROP TABLE books")
+    c.execute("ALTER TABLE books_new RENAME TO books")
+
+    # Backfill isbn13; when two rows are the same book, the oldest keeps it
+    seen, updates = set(), []
+    for row in c.execute("SELECT id, isbn FROM books ORDER BY id").fetchall():
+        isbn13 = normalize_isbn(row[1])
+        if isbn13 and isbn13 not in seen:
+            seen.add(isbn13)
+            updates.append((isbn13, row[0]))
+    c.executemany("UPDATE books SET isbn13=? WHERE id=?", updates)
+
+    c.execute("CREATE UNIQUE INDEX idx_books_isbn13 ON books(isbn13) WHERE isbn13 IS NOT NULL")
+    c.execute("CREATE INDEX idx_books_owner_title ON books(owner_id, title, id)")
+    c.execute("CREATE INDEX idx_books_owner_in_library ON books(owner_id, in_library)")
+    c.execute("CREATE INDEX idx_books_title ON books(title, id)")
+
+    # The old table's triggers went with it; catalog_versions is re-keyed by owner_id (0 = all owners)
+    c.execute("DROP TABLE catalog_versions")
+    c.execute('''CREATE TABLE catalog_versions (
+                    owner_id INTEGER PRIMARY KEY,
+                    version INTEGER NOT NULL
+                )''')
+    c.execute('''INSERT INTO catalog_versions (owner_id, version)
+                 SELECT DISTINCT owner_id, 1 FROM books WHERE owner_id IS NOT NULL
+                 UNION SELECT 0, 1''')
+    execute_script(c, '''
+        CREATE TRIGGER books_fts_ai AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts(rowid, title, authors, publisher, isbn)
+            VALUES (new.id, new.title, new.authors, new.publisher, new.isbn);
+        END;
+        CREATE TRIGGER books_fts_ad AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts(books_fts, rowid, title, authors, publisher, isbn)
+            VALUES ('delete', old.id, old.title, old.authors, old.publisher, old.isbn);
+        END;
+        CREATE TRIGGER books_fts_au AFTER UPDATE OF title, authors, publisher, isbn ON books BEGIN
+            INSERT INTO books_fts(books_fts, rowid, title, authors, publisher, isbn)
+            VALUES ('delete', old.id, old.title, old.authors, old.publisher, old.isbn);
+            INSERT INTO books_fts(rowid, title, authors, publisher, isbn)
+            VALUES (new.id, new.title, new.authors, new.publisher, new.isbn);
+        END;
+        CREATE TRIGGER books_version_ai AFTER INSERT ON books BEGIN
+            INSERT INTO catalog_versions(owner_id, version)
+            SELECT value, 1 FROM json_each(json_array(0, new.owner_id)) WHERE value IS NOT NULL
+            ON CONFLICT(owner_id) DO UPDATE SET version = version + 1;
+        END;
+        CREATE TRIGGER books_version_ad AFTER DELETE ON books BEGIN
+            INSERT INTO catalog_versions(owner_id, version)
+            SELECT value, 1 FROM json_each(json_array(0, old.owner_id)) WHERE value IS NOT NULL
+            ON CONFLICT(owner_id) DO UPDATE SET version = version + 1;
+        END;
+        CREATE TRIGGER books_version_au AFTER UPDATE ON books BEGIN
+            INSERT INTO catalog_versions(owner_id, version)
+            SELECT value, 1 FROM json_each(json_array(0, old.owner_id,
+                CASE WHEN new.owner_id IS NOT old.owner_id THEN new.owner_id END)) WHERE value IS NOT NULL
+            ON CONFLICT(owner_id) DO UPDATE SET version = version + 1;
+        END;
+    ''')
+
+def migration_3_sessions_roles(c):
+    # Roles replace comparing the username against 'admin'
+    c.execute("ALTER TABLE users ADD COLUMN role TEXT NOT NULL DEFAULT 'user'")
+    c.execute("UPDATE users SET role='admin' WHERE username='admin'")
+    # Server-side sessions; the cookie only carries the random id
+    execute_script(c, '''
+        CREATE TABLE sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX idx_sessions_user ON sessions(user_id);
+        CREATE INDEX idx_sessions_expires ON sessions(expires_at);
+    ''')
+
+def migration_4_facets(c):
+    # book_facets holds each book's (facet, value) pairs -- one row per author, plus publisher,
+    # decade and in_library -- and facet_counts their per-owner totals (owner 0 = all owners).
+    # Triggers on books keep book_facets current and triggers on book_facets keep the counts.
+    # book_facets also carries the title so a filtered catalog page is a keyset walk of its index.
+    # Authors are stored ", "-joined; quoting the string as JSON first and splitting on the
+    # separator turns it into a JSON array json_each can walk.
+    facet_rows = '''
+        INSERT INTO book_facets (book_id, owner_id, title, facet, value)
+        SELECT new.id, new.owner_id, new.title, 'author', value
+            FROM json_each('[' || replace(json_quote(new.authors), ', ', '", "') || ']') WHERE value != ''
+        UNION SELECT new.id, new.owner_id, new.title, 'publisher', new.publisher WHERE new.publisher != ''
+        UNION SELECT new.id, new.owner_id, new.title, 'decade', substr(new.publishedDate, 1, 3) || '0s'
+            WHERE new.publishedDate GLOB '[0-9][0-9][0-9][0-9]*'
+        UNION SELECT new.id, new.owner_id, new.title, 'in_library', CASE WHEN new.in_library THEN '1' ELSE '0' END;
+    '''
+    execute_script(c, f'''
+        CREATE TABLE book_facets (
+            book_id INTEGER NOT NULL REFERENCES books(id) ON DELETE CASCADE,
+            owner_id INTEGER,
+            title TEXT,
+            facet TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (book_id, facet, value)
+        ) WITHOUT ROWID;
+        CREATE INDEX idx_book_facets_owner ON book_facets(owner_id, facet, value, title, book_id);
+        CREATE INDEX idx_book_facets_value ON book_facets(facet, value, title, book_id);
+        CREATE TABLE facet_counts (
+            owner_id INTEGER NOT NULL,
+            facet TEXT NOT NULL,
+            value TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (owner_id, facet, value)
+        ) WITHOUT ROWID;
+        CREATE INDEX idx_facet_counts_top ON facet_counts(owner_id, facet, count DESC, value);
+
+        CREATE TRIGGER books_facets_ai AFTER INSERT ON books BEGIN
+            {facet_rows}
+        END;
+        CREATE TRIGGER books_facets_ad AFTER DELETE ON books BEGIN
+            DELETE FROM book_facets WHERE book_id = old.id;
+        END;
+        CREATE TRIGGER books_facets_au AFTER UPDATE OF title, authors, publisher, publishedDate, in_library, owner_id ON books BEGIN
+            DELETE FROM book_facets WHERE book_id = old.id;
+            {facet_rows}
+        END;
+        CREATE TRIGGER book_facets_ai AFTER INSERT ON book_facets BEGIN
+            INSERT INTO facet_counts (owner_id, facet, value, count)
+            SELECT o.value, new.facet, new.value, 1
+            FROM json_each(json_array(0, new.owner_id)) o WHERE o.value IS NOT NULL
+            ON CONFLICT(owner_id, facet, value) DO UPDATE SET count = count + 1;
+        END;
+        CREATE TRIGGER book_facets_ad AFTER DELETE ON book_facets BEGIN
+            UPDATE facet_counts SET count = count - 1
+            WHERE owner_id IN (0, old.owner_id) AND facet = old.facet AND value = old.value;
+            DELETE FROM facet_counts
+            WHERE owner_id IN (0, old.owner_id) AND facet = old.facet AND value = old.value AND count <= 0;
+        END;
+    ''')
+    # Backfill: touching every row runs it through books_facets_au
+    c.execute("UPDATE books SET in_library = in_library")
+
+def migration_5_change_log(c):
+    # Every change to a book takes the next sync_counter value: inserts and updates stamp it on
+    # books.version, deletes leave a tombstone with it, so /api/changes can send just what
+    # changed since a client's last sync. Moving a book to another owner leaves a `moved`
+    # tombstone for the old owner. sync_counter.pruned is the newest tombstone version that
+    # has been pruned; clients that synced before it have to start over.
+    columns = "title, authors, publisher, publishedDate, isbn, isbn13, cover_url, in_library, owner_id"
+    execute_script(c, f'''
+        ALTER TABLE books ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+        CREATE TABLE sync_counter (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            pruned INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE book_tombstones (
+            book_id INTEGER NOT NULL,
+            owner_id INTEGER,
+            moved INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL,
+            deleted_at REAL NOT NULL DEFAULT ((julianday('now') - 2440587.5) * 86400.0)
+        );
+        CREATE INDEX idx_tombstones_owner_version ON book_tombstones(owner_id, version);
+        CREATE INDEX idx_tombstones_version ON book_tombstones(version);
+        CREATE INDEX idx_tombstones_deleted_at ON book_tombstones(deleted_at);
+
+        -- Stamping books.version is itself an UPDATE of books, so the catalog version trigger
+        -- now lists the columns it cares about instead of firing twice per change
+        DROP TRIGGER books_version_au;
+        CREATE TRIGGER books_version_au AFTER UPDATE OF {columns} ON books BEGIN
+            INSERT INTO catalog_versions(owner_id, version)
+            SELECT value, 1 FROM json_each(json_array(0, old.owner_id,
+                CASE WHEN new.owner_id IS NOT old.owner_id THEN new.owner_id END)) WHERE value IS NOT NULL
+            ON CONFLICT(owner_id) DO UPDATE SET version = version + 1;
+        END;
+
+        CREATE TRIGGER books_sync_ai AFTER INSERT ON books BEGIN
+            UPDATE sync_counter SET version = version + 1;
+            UPDATE books SET version = (SELECT version FROM sync_counter) WHERE id = new.id;
+        END;
+        CREATE TRIGGER books_sync_au AFTER UPDATE OF {columns} ON books BEGIN
+            UPDATE sync_counter SET version = version + 1;
+            UPDATE books SET version = (SELECT version FROM sync_counter) WHERE id = new.id;
+            INSERT INTO book_tombstones (book_id, owner_id, moved, version)
+            SELECT old.id, old.owner_id, 1, version FROM sync_counter
+            WHERE old.owner_id IS NOT NULL AND old.owner_id IS NOT new.owner_id;
+        END;
+        CREATE TRIGGER books_sync_ad AFTER DELETE ON books BEGIN
+            UPDATE sync_counter SET version = version + 1;
+            INSERT INTO book_tombstones (book_id, owner_id, version)
+            SELECT old.id, old.owner_id, version FROM sync_counter;
+        END;
+    ''')
+    # Existing books count as changed once, in id order
+    c.execute("UPDATE books SET version = id")
+    c.execute("INSERT INTO sync_counter (id, version) SELECT 1, COALESCE(MAX(id), 0) FROM books")
+    c.execute("CREATE INDEX idx_books_owner_version ON books(owner_id, version)")
+    c.execute("CREATE INDEX idx_books_version ON books(version)")
+
+def migration_6_user_list_index(c):
+    # The user management page pages through users by username, optionally only pending ones
+    c.execute("CREATE INDEX idx_users_approved_username ON users(approved, username, id)")
+
+MIGRATIONS = [
+    migration_1_baseline,
+    migration_2_owner_id_isbn13,
+    migration_3_sessions_roles,
+    migration_4_facets,
+    migration_5_change_log,
+    migration_6_user_list_index,
+]
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return
+    # Table rebuilds need foreign keys off; the pragma is a no-op inside a transaction
+    conn.execute("PRAGMA foreign_keys=OFF")
+    try:
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                migration(conn.cursor())
+                problems = conn.execute("PRAGMA foreign_key_check").fetchall()
+                if problems:
+                    raise sqlite3.IntegrityError(f"migration {number} broke {len(problems)} foreign keys")
+                conn.execute(f"PRAGMA user_version={number}")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    finally:
+        conn.execute("PRAGMA foreign_keys=ON")
+
+def init_db(path=None):
+    # Schema setup is explicit (`flask --app app init-db`, or `python3 app.py` before serving)
+    # rather than an import side effect, so worker processes and tests start without it
+    conn = connect_db(path or app.config['DATABASE'])
+    try:
+        migrate(conn)
+        # Default admin
+        c = conn.cursor()
+        c.execute("SELECT * FROM users WHERE username='admin'")
+        if not c.fetchone():
+            c.execute("INSERT INTO users (username, password, approved, role) VALUES (?, ?, ?, 'admin')",
+                      ('admin', hash_password('admin123'), 1))
+        conn.commit()
+    finally:
+        conn.close()
+
+def check_schema(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < len(MIGRATIONS):
+        raise RuntimeError(f"database schema is at version {version} of {len(MIGRATIONS)}; "
+                           "run `flask --app app init-db` first")
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create or migrate the database and add the default admin."""
+    init_db()
+    print(f"Database ready: {app.config['DATABASE']} (schema version {len(MIGRATIONS)})")
+
+# ---------------- Search -----------------
+SEARCH_LIMIT = 50
+
+def fts_query(text):
+    # Quote every term so user input can't inject FTS5 syntax; trailing * makes it a prefix match
+    terms = re.findall(r'\w+', text)
+    return ' '.join(f'"{t}"*' for t in terms)
+
+def search_books(conn, text, owner_id=None, limit=SEARCH_LIMIT):
+    query = fts_query(text)
+    if not query:
+        return []
+    sql = '''SELECT b.* FROM books_fts
+             JOIN books b ON b.id = books_fts.rowid
+             WHERE books_fts MATCH ?'''
+    params = [query]
+    if owner_id is not None:
+        sql += " AND b.owner_id=?"
+        params.append(owner_id)
+    # Weight title matches above authors, publisher and isbn
+    sql += " ORDER BY bm25(books_fts, 10.0, 5.0, 2.0, 1.0) LIMIT ?"
+    params.append(limit)
+    return conn.execute(sql, params).fetchall()
+
+# ---------------- Paging -----------------
+PAGE_SIZE = 48
+EXPORT_BATCH_SIZE = 500
+
+def encode_cursor(row, key='title'):
+    raw = json.dumps([row[key], row['id']]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(token):
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return value, int(row_id)
+    except (ValueError, TypeError):
+        return None
+
+def fetch_book_page(conn, owner_id=None, cursor=None, limit=PAGE_SIZE, in_library=None, facets=()):
+    # Keyset pagination on (title, id): each page costs the same no matter how deep it is.
+    # Facet-filtered pages walk the first facet's rows in book_facets instead of books.
+    if facets:
+        (facet, value), facets = facets[0], facets[1:]
+        sql = "SELECT b.* FROM book_facets f JOIN books b ON b.id = f.book_id"
+        clauses, params = ["f.facet=?", "f.value=?"], [facet, value]
+        owner_col, key = "f.owner_id", "f.title, f.book_id"
+    else:
+        sql = "SELECT * FROM books b"
+        clauses, params = [], []
+        owner_col, key = "b.owner_id", "b.title, b.id"
+    if owner_id is not None:
+        clauses.append(f"{owner_col}=?")
+        params.append(owner_id)
+    if in_library is not None:
+        clauses.append("b.in_library=?")
+        params.append(in_library)
+    for facet, value in facets:
+        clauses.append("b.id IN (SELECT book_id FROM book_facets WHERE facet=? AND value=?)")
+        params.extend((facet, value))
+    after = decode_cursor(cursor) if cursor else None
+    if after:
+        clauses.append(f"({key}) > (?, ?)")
+        params.extend(after)
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += f" ORDER BY {key} LIMIT ?"
+    params.append(limit + 1)
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def catalog_version(conn, owner_id=None):
+    row = conn.execute("SELECT version FROM catalog_versions WHERE owner_id=?",
+                       (ALL_OWNERS if owner_id is None else owner_id,)).fetchone()
+    return row['version'] if row else 0
+
+def iter_books(conn, owner_id=None, batch_size=EXPORT_BATCH_SIZE):
+    # Stream rows in batches instead of materialising the whole catalog
+    if owner_id is None:
+        cur = conn.execute("SELECT * FROM books ORDER BY title, id")
+    else:
+        cur = conn.execute("SELECT * FROM books WHERE owner_id=? ORDER BY title, id", (owner_id,))
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+# ---------------- Facets -----------------
+# Counts come from facet_counts, which triggers keep current (see migration 4), so reading
+# them is a few index probes however large the catalog is
+FACET_FILTERS = ('author', 'publisher', 'decade')
+FACET_LIMIT = 10
+FACET_MAX_LIMIT = 100
+
+def active_facets(args):
+    # (facet, value) filters from the query string, in a stable order for cache keys
+    return tuple((facet, args[facet]) for facet in FACET_FILTERS if args.get(facet))
+
+def facet_counts(conn, owner_id=None, limit=FACET_LIMIT):
+    owner = ALL_OWNERS if owner_id is None else owner_id
+    facets = {}
+    for facet in FACET_FILTERS:
+        rows = conn.execute('''SELECT value, count FROM facet_counts WHERE owner_id=? AND facet=?
+                               ORDER BY count DESC, value LIMIT ?''', (owner, facet, limit)).fetchall()
+        facets[facet] = [{'value': r['value'], 'count': r['count']} for r in rows]
+    shelf = {r['value']: r['count'] for r in conn.execute(
+        "SELECT value, count FROM facet_counts WHERE owner_id=? AND facet='in_library'", (owner,))}
+    return {'total': sum(shelf.values()), 'in_library': shelf.get('1', 0), 'checked_out': shelf.get('0', 0),
+            'facets': facets}
+
+# ---------------- Google Books -----------------
+_http = None
+_http_lock = threading.Lock()
+
+def http_session():
+    # Shared keep-alive session, with enough pooled sockets for the import workers
+    global _http
+    with _http_lock:
+        if _http is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            _http = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=IMPORT_WORKERS)
+            _http.mount('https://', adapter)
+            _http.mount('http://', adapter)
+            if app.config['METRICS']:
+                _http.hooks['response'].append(record_http_client)
+        return _http
+
+def clean_isbn(raw):
+    isbn = re.sub(r'[^0-9Xx]', '', raw or '').upper()
+    return isbn if len(isbn) in (10, 13) else None
+
+def normalize_isbn(raw):
+    # Checksum-validated ISBN-13 for either form of the same book, else None
+    isbn = clean_isbn(raw)
+    if isbn is None:
+        return None
+    if len(isbn) == 10:
+        if not re.fullmatch(r'\d{9}[\dX]', isbn):
+            return None
+        digits = [10 if ch == 'X' else int(ch) for ch in isbn]
+        if sum((10 - i) * d for i, d in enumerate(digits)) % 11:
+            return None
+        isbn = '978' + isbn[:9]
+        return isbn + str(-sum((3 if i % 2 else 1) * int(ch) for i, ch in enumerate(isbn)) % 10)
+    if not isbn.isdigit() or sum((3 if i % 2 else 1) * int(ch) for i, ch in enumerate(isbn)) % 10:
+        return None
+    return isbn
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+def parse_volume_info(data):
+    if 'items' not in data:
+        return None
+    info = data['items'][0]['volumeInfo']
+    return {
+        'title': info.get('title', ''),
+        'authors': ", ".join(info.get('authors', [])),
+        'publisher': info.get('publisher', ''),
+        'publishedDate': info.get('publishedDate', ''),
+        'thumbnail': info.get('imageLinks', {}).get('thumbnail', ''),
+    }
+
+def fetch_book_info(isbn):
+    # Book fields from Google Books, or None when the ISBN is unknown. A 429 or 5xx raises
+    # instead, so the job is retried rather than the book being dropped as not found.
+    resp = http_session().get(GOOGLE_BOOKS_URL, params={'q': f'isbn:{isbn}'}, timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    return parse_volume_info(resp.json())
+
+def save_cover(filename, content):
+    os.makedirs(COVERS_DIR, exist_ok=True)
+    with open(os.path.join(COVERS_DIR, filename), 'wb') as f:
+        f.write(content)
+    process_cover(filename)
+    return filename
+
+def download_cover(isbn, cover_url):
+    # Saves the cover under COVERS_DIR and returns its filename, or None
+    filename = f"{isbn}.jpg"
+    if os.path.exists(os.path.join(COVERS_DIR, filename)):
+        return filename
+    r = http_session().get(cover_url, timeout=HTTP_TIMEOUT)
+    if r.status_code != 200:
+        return None
+    return save_cover(filename, r.content)
+
+# ---------------- Covers -----------------
+# Every downloaded cover is resized into each COVER_SIZES x COVER_FORMATS variant, served by
+# cover() with a content-hash ETag. Covers saved before this pipeline are converted on first request.
+_cover_etags = LRUCache(4096)
+
+def cover_variant_path(stem, size, fmt):
+    return os.path.join(COVER_VARIANTS_DIR, f"{stem}-{size}.{fmt}")
+
+def process_cover(filename):
+    from PIL import Image
+    stem = os.path.splitext(filename)[0]
+    try:
+        with Image.open(os.path.join(COVERS_DIR, filename)) as img:
+            img = img.convert('RGB')
+        os.makedirs(COVER_VARIANTS_DIR, exist_ok=True)
+        for size, box in COVER_SIZES.items():
+            variant = img.copy()
+            variant.thumbnail(box, Image.LANCZOS)
+            for fmt, (pil_format, _, options) in COVER_FORMATS.items():
+                path = cover_variant_path(stem, size, fmt)
+                variant.save(path + '.tmp', pil_format, **options)
+                os.replace(path + '.tmp', path)
+    except (OSError, KeyError, ValueError):
+        return False
+    return True
+
+def cover_variant(stem, size, fmt):
+    # Path of a cover variant, generating the set from the original if it isn't there yet
+    path = cover_variant_path(stem, size, fmt)
+    if os.path.exists(path):
+        return path
+    if os.path.exists(os.path.join(COVERS_DIR, stem + '.jpg')) and process_cover(stem + '.jpg'):
+        if os.path.exists(path):
+            return path
+    return None
+
+def file_etag(path):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    etag = _cover_etags.get(key)
+    if etag is None:
+        with open(path, 'rb') as f:
+            etag = hashlib.sha1(f.read()).hexdigest()
+        _cover_etags.put(key, etag)
+    return etag
+
+# ---------------- ISBN Cache -----------------
+# In-process LRU in front of the isbn_cache table, which in turn sits in front of Google Books
+_isbn_lru = LRUCache(ISBN_LRU_SIZE)
+_MISSING = object()
+isbn_cache_stats = {'lru_hits': 0, 'db_hits': 0, 'negative_hits': 0, 'misses': 0}
+_isbn_stats_lock = threading.Lock()
+
+def isbn_cache_event(kind):
+    # Lookups run on import pool threads, job workers and request threads at once
+    with _isbn_stats_lock:
+        isbn_cache_stats[kind] += 1
+
+def isbn_cache_counts():
+    with _isbn_stats_lock:
+        return dict(isbn_cache_stats)
+
+def isbn_cache_get(isbn13):
+    # Cached book fields, None for a cached "not found", or _MISSING
+    now = time.time()
+    entry = _isbn_lru.get(isbn13)
+    if entry is not None and entry[1] > now:
+        isbn_cache_event('lru_hits')
+        info = entry[0]
+    else:
+        row = get_db().execute("SELECT data, fetched_at FROM isbn_cache WHERE isbn13=?", (isbn13,)).fetchone()
+        if row is None:
+            return _MISSING
+        info = json.loads(row['data']) if row['data'] else None
+        expires = row['fetched_at'] + (ISBN_CACHE_TTL if info else ISBN_NEGATIVE_TTL)
+        if expires <= now:
+            return _MISSING
+        isbn_cache_event('db_hits')
+        _isbn_lru.put(isbn13, (info, expires))
+    if info is None:
+        isbn_cache_event('negative_hits')
+    return info
+
+def isbn_cache_put(isbn13, info):
+    now = time.time()
+    conn = get_db()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO isbn_cache (isbn13, data, fetched_at) VALUES (?, ?, ?)",
+                     (isbn13, json.dumps(info) if info else None, now))
+    _isbn_lru.put(isbn13, (info, now + (ISBN_CACHE_TTL if info else ISBN_NEGATIVE_TTL)))
+
+def lookup_book_info(isbn):
+    # fetch_book_info() behind the cache; ISBN-10 and ISBN-13 forms share an entry.
+    # A failed request raises before isbn_cache_put, so only a real "no items" answer is cached as None.
+    key = normalize_isbn(isbn)
+    if key is None:
+        return fetch_book_info(isbn)
+    info = isbn_cache_get(key)
+    if info is not _MISSING:
+        return info
+    isbn_cache_event('misses')
+    info = fetch_book_info(isbn)
+    isbn_cache_put(key, info)
+    return info
+
+# ---------------- Background Jobs -----------------
+# Jobs live in the jobs table: queued -> running -> done, or back to queued with exponential
+# backoff on error until JOB_MAX_ATTEMPTS is reached (failed). A running job whose lease has
+# expired (its worker died with the process) is picked up again.
+JOB_HANDLERS = {}
+_job_wakeup = threading.Event()
+_job_workers = []
+_job_workers_lock = threading.Lock()
+
+def job_handler(kind):
+    def register(f):
+        JOB_HANDLERS[kind] = f
+        return f
+    return register
+
+def enqueue_job(conn, kind, payload, book_id=None, owner=None):
+    # Runs inside the caller's transaction; call notify_job_workers() once it commits
+    now = time.time()
+    c = conn.execute('''INSERT INTO jobs (kind, payload, book_id, owner, run_after, created_at, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                     (kind, json.dumps(payload), book_id, owner, now, now, now))
+    return c.lastrowid
+
+def notify_job_workers():
+    start_job_workers()
+    _job_wakeup.set()
+
+def claim_job(conn):
+    now = time.time()
+    # A single UPDATE ... RETURNING, so two workers can never claim the same row
+    job = conn.execute('''UPDATE jobs SET state='running', attempts=attempts+1, updated_at=?
+                          WHERE id = (SELECT id FROM jobs
+                                      WHERE (state='queued' AND run_after<=?)
+                                         OR (state='running' AND updated_at<?)
+                                      ORDER BY run_after, id LIMIT 1)
+                          RETURNING *''', (now, now, now - JOB_LEASE)).fetchone()
+    conn.commit()
+    return job
+
+def finish_job(conn, job, result=None, error=None):
+    if error is not None:
+        if job['attempts'] >= JOB_MAX_ATTEMPTS:
+            state, run_after = 'failed', job['run_after']
+        else:
+            state, run_after = 'queued', time.time() + JOB_BACKOFF_BASE ** job['attempts']
+        conn.execute("UPDATE jobs SET state=?, run_after=?, last_error=?, updated_at=? WHERE id=?",
+                     (state, run_after, f"{type(error).__name__}: {error}", time.time(), job['id']))
+    else:
+        conn.execute("UPDATE jobs SET state='done', result=?, last_error=NULL, updated_at=? WHERE id=?",
+                     (json.dumps(result), time.time(), job['id']))
+    conn.commit()
+
+def job_payload(job):
+    # Handlers that report progress (imports) find their own row id in the payload
+    return dict(json.loads(job['payload']), job_id=job['id'])
+
+def run_job(conn, job):
+    try:
+        result = JOB_HANDLERS[job['kind']](job_payload(job))
+    except Exception as e:
+        finish_job(conn, job, error=e)
+    else:
+        finish_job(conn, job, result)
+
+def prune_expired(conn):
+    conn.execute("DELETE FROM jobs WHERE state='done' AND updated_at<?", (time.time() - JOB_RETENTION,))
+    conn.execute("DELETE FROM sessions WHERE expires_at<?", (time.time(),))
+    # Clients that last synced before the pruned tombstones get a full resync instead
+    cutoff = time.time() - TOMBSTONE_RETENTION
+    c = conn.execute('''UPDATE sync_counter SET pruned = (SELECT MAX(version) FROM book_tombstones WHERE deleted_at<?)
+                        WHERE EXISTS (SELECT 1 FROM book_tombstones WHERE deleted_at<?)''', (cutoff, cutoff))
+    if c.rowcount:
+        conn.execute("DELETE FROM book_tombstones WHERE version <= (SELECT pruned FROM sync_counter)")
+    conn.commit()
+
+def wait_for_jobs():
+    _job_wakeup.wait(JOB_POLL_INTERVAL)
+    _job_wakeup.clear()
+
+def job_worker():
+    while True:
+        with app.app_context():
+            conn = get_db()
+            job = claim_job(conn)
+            if job is not None:
+                run_job(conn, job)
+                continue
+            prune_expired(conn)
+        wait_for_jobs()
+
+def start_job_workers(count=JOB_WORKERS):
+    with _job_workers_lock:
+        if _job_workers:
+            return
+        if app.config['ASYNC_JOBS']:
+            t = threading.Thread(target=async_job_worker, name="job-worker-async", daemon=True)
+            t.start()
+            _job_workers.append(t)
+            return
+        for i in range(count):
+            t = threading.Thread(target=job_worker, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            _job_workers.append(t)
+
+def apply_enrichment(conn, book_id, info, local_cover):
+    if info is None:
+        # Same outcome as the old synchronous add: unknown ISBNs don't stay in the catalog
+        conn.execute("DELETE FROM books WHERE id=?", (book_id,))
+        conn.commit()
+        return {'found': False}
+    conn.execute('''UPDATE books SET title=?, authors=?, publisher=?, publishedDate=?, cover_url=?
+                    WHERE id=?''',
+                 (info['title'], info['authors'], info['publisher'], info['publishedDate'], local_cover, book_id))
+    conn.commit()
+    return {'found': True}
+
+@job_handler('enrich_book')
+def enrich_book(payload):
+    isbn = payload['isbn']
+    info = lookup_book_info(isbn)
+    local_cover = download_cover(isbn, info['thumbnail']) if info and info['thumbnail'] else None
+    return apply_enrichment(get_db(), payload['book_id'], info, local_cover)
+
+def with_job_state(conn, books):
+    # Book rows as dicts flagged with whether enrichment is still outstanding
+    books = [dict(b) for b in books]
+    if books:
+        rows = conn.execute('''SELECT DISTINCT book_id FROM jobs
+                               WHERE book_id IN (SELECT value FROM json_each(?))
+                                 AND kind='enrich_book' AND state IN ('queued', 'running')''',
+                            (json.dumps([b['id'] for b in books]),)).fetchall()
+        pending = {r['book_id'] for r in rows}
+        for b in books:
+            b['pending'] = b['id'] in pending
+    return books
+
+# ---------------- Bulk Import -----------------
+# An import is an 'import_books' job. Its progress is written to the job's result column as it
+# goes, so /import/<id> can be answered by any worker process, not just the one running it.
+
+def parse_isbn_upload(req):
+    # Accepts a JSON list (or {"isbns": [...]}) or an uploaded text/CSV file
+    if req.is_json:
+        data = req.get_json(silent=True)
+        raw = data.get('isbns', []) if isinstance(data, dict) else data
+        raw = [str(v) for v in raw] if isinstance(raw, list) else []
+    elif 'file' in req.files:
+        text = req.files['file'].read().decode('utf-8', errors='replace')
+        raw = [cell for row in csv.reader(text.splitlines()) for cell in row]
+    else:
+        raw = []
+    # Keyed by the normalized form, so the ISBN-10 and ISBN-13 of one book are looked up once
+    isbns, invalid = {}, []
+    for value in raw:
+        isbn = clean_isbn(value)
+        if isbn:
+            isbns.setdefault(normalize_isbn(isbn) or isbn, isbn)
+        elif value.strip():
+            invalid.append(value.strip())
+    return list(isbns.values()), invalid
+
+def existing_isbns(conn, isbns):
+    # ISBNs (as given) already in the catalog under either their raw or normalized form.
+    # One query regardless of list length; json_each sidesteps the bound-parameter limit.
+    wanted = {isbn: normalize_isbn(isbn) for isbn in isbns}
+    rows = conn.execute('''SELECT isbn, isbn13 FROM books
+                           WHERE isbn IN (SELECT value FROM json_each(?))
+                              OR isbn13 IN (SELECT value FROM json_each(?))''',
+                        (json.dumps(isbns), json.dumps([v for v in wanted.values() if v]))).fetchall()
+    found = {r['isbn'] for r in rows} | {r['isbn13'] for r in rows if r['isbn13']}
+    return {isbn for isbn, isbn13 in wanted.items() if isbn in found or isbn13 in found}
+
+def import_row(isbn, info, local_cover, owner_id):
+    return (info['title'], info['authors'], info['publisher'], info['publishedDate'], isbn,
+            normalize_isbn(isbn), local_cover, owner_id)
+
+def fetch_import_row(isbn, owner_id):
+    with app.app_context():
+        info = lookup_book_info(isbn)
+    if info is None:
+        return None
+    local_cover = download_cover(isbn, info['thumbnail']) if info['thumbnail'] else None
+    return import_row(isbn, info, local_cover, owner_id)
+
+def new_import_progress(payload):
+    # Every ISBN ends up in exactly one of added, duplicates, not_found or errors, so they sum to
+    # total; the ones already in the catalog are settled before any lookup
+    duplicates = len(payload['duplicates'])
+    return {'total': len(payload['isbns']) + duplicates, 'processed': duplicates, 'added': 0,
+            'duplicates': payload['duplicates'], 'invalid': payload['invalid'],
+            'not_found': [], 'errors': []}
+
+def save_import_progress(conn, job_id, progress):
+    # Also renews the job's lease, so a long import isn't claimed by another worker
+    conn.execute("UPDATE jobs SET result=?, updated_at=? WHERE id=?", (json.dumps(progress), time.time(), job_id))
     conn.commit()
-    conn.close()
 
-init_db()
+def import_recorder(conn, job_id, progress, rows):
+    last_saved = [time.monotonic()]
+
+    def record(isbn, row, error):
+        if error is not None:
+            progress['errors'].append({'isbn': isbn, 'message': str(error)})
+        elif row is None:
+            progress['not_found'].append(isbn)
+        else:
+            rows.append(row)
+        progress['processed'] += 1
+        if time.monotonic() - last_saved[0] >= IMPORT_PROGRESS_INTERVAL:
+            save_import_progress(conn, job_id, progress)
+            last_saved[0] = time.monotonic()
+    return record
+
+def insert_import_rows(conn, progress, rows):
+    with conn:
+        for row in rows:
+            # OR IGNORE covers ISBNs added by someone else while the lookups ran; report them
+            # as duplicates rather than dropping them
+            added = conn.execute('''INSERT OR IGNORE INTO books
+                                    (title, authors, publisher, publishedDate, isbn, isbn13, cover_url, owner_id)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?) RETURNING id''', row).fetchone()
+            if added:
+                progress['added'] += 1
+            else:
+                progress['duplicates'].append(row[4])
+    return progress
+
+@job_handler('import_books')
+def import_books_job(payload):
+    conn = get_db()
+    progress, rows = new_import_progress(payload), []
+    record = import_recorder(conn, payload['job_id'], progress, rows)
+    with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as pool:
+        futures = {pool.submit(fetch_import_row, isbn, payload['owner_id']): isbn for isbn in payload['isbns']}
+        for future in as_completed(futures):
+            try:
+                row = future.result()
+            except Exception as e:
+                record(futures[future], None, e)
+            else:
+                record(futures[future], row, None)
+    return insert_import_rows(conn, progress, rows)
+
+def start_import(conn, owner, owner_id, isbns, duplicates, invalid):
+    payload = {'owner_id': owner_id, 'isbns': isbns, 'duplicates': duplicates, 'invalid': invalid}
+    with conn:
+        job_id = enqueue_job(conn, 'import_books', payload, owner=owner)
+    notify_job_workers()
+    return job_id
+
+# ---------------- Async Enrichment -----------------
+# The asyncio side of the job queue and bulk import, used when ASYNC_JOBS is set. Network I/O
+# goes through one httpx.AsyncClient per loop; cache lookups and the database writes share
+# the sync code above and run between awaits, so each task's transactions stay atomic.
+ASYNC_JOB_HANDLERS = {}
+
+def async_job_handler(kind):
+    def register(f):
+        ASYNC_JOB_HANDLERS[kind] = f
+        return f
+    return register
+
+def async_http_client():
+    import httpx
+    hooks = None
+    if app.config['METRICS']:
+        hooks = {'request': [start_http_client_timer], 'response': [record_http_client_async]}
+    return httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=httpx.Limits(max_connections=ASYNC_LOOKUPS,
+                                                                       max_keepalive_connections=32),
+                             event_hooks=hooks)
+
+async def fetch_book_info_async(client, isbn):
+    resp = await client.get(GOOGLE_BOOKS_URL, params={'q': f'isbn:{isbn}'})
+    resp.raise_for_status()
+    return parse_volume_info(resp.json())
+
+async def lookup_book_info_async(client, isbn):
+    key = normalize_isbn(isbn)
+    if key is None:
+        return await fetch_book_info_async(client, isbn)
+    info = isbn_cache_get(key)
+    if info is not _MISSING:
+        return info
+    isbn_cache_event('misses')
+    info = await fetch_book_info_async(client, isbn)
+    isbn_cache_put(key, info)
+    return info
+
+async def download_cover_async(client, isbn, cover_url):
+    filename = f"{isbn}.jpg"
+    if os.path.exists(os.path.join(COVERS_DIR, filename)):
+        return filename
+    r = await client.get(cover_url)
+    if r.status_code != 200:
+        return None
+    # Resizing is CPU work; keep it off the event loop
+    return await asyncio.to_thread(save_cover, filename, r.content)
+
+@async_job_handler('enrich_book')
+async def enrich_book_async(client, payload):
+    isbn = payload['isbn']
+    info = await lookup_book_info_async(client, isbn)
+    local_cover = await download_cover_async(client, isbn, info['thumbnail']) if info and info['thumbnail'] else None
+    return apply_enrichment(get_db(), payload['book_id'], info, local_cover)
+
+def run_in_app_context(f, *args):
+    with app.app_context():
+        return f(*args)
+
+async def run_job_async(conn, client, job):
+    payload = job_payload(job)
+    try:
+        handler = ASYNC_JOB_HANDLERS.get(job['kind'])
+        if handler is not None:
+            result = await handler(client, payload)
+        else:
+            # Blocking handlers (PDF export) get a thread and their own connection
+            result = await asyncio.to_thread(run_in_app_context, JOB_HANDLERS[job['kind']], payload)
+    except Exception as e:
+        finish_job(conn, job, error=e)
+    else:
+        finish_job(conn, job, result)
+
+async def async_job_loop():
+    conn = get_db()
+    running = set()
+    async with async_http_client() as client:
+        while True:
+            while len(running) < ASYNC_LOOKUPS:
+                job = claim_job(conn)
+                if job is None:
+                    break
+                running.add(asyncio.create_task(run_job_async(conn, client, job)))
+            if running:
+                _, running = await asyncio.wait(running, timeout=JOB_POLL_INTERVAL,
+                                                return_when=asyncio.FIRST_COMPLETED)
+            else:
+                prune_expired(conn)
+                await asyncio.to_thread(wait_for_jobs)
+
+def async_job_worker():
+    with app.app_context():
+        asyncio.run(async_job_loop())
+
+async def fetch_import_rows_async(client, isbns, owner_id, record):
+    limit = asyncio.Semaphore(ASYNC_LOOKUPS)
+
+    async def fetch(isbn):
+        async with limit:
+            try:
+                info = await lookup_book_info_async(client, isbn)
+                local_cover = None
+                if info and info['thumbnail']:
+                    local_cover = await download_cover_async(client, isbn, info['thumbnail'])
+            except Exception as e:
+                record(isbn, None, e)
+            else:
+                record(isbn, import_row(isbn, info, local_cover, owner_id) if info else None, None)
+    await asyncio.gather(*(fetch(isbn) for isbn in isbns))
+
+@async_job_handler('import_books')
+async def import_books_async(client, payload):
+    conn = get_db()
+    progress, rows = new_import_progress(payload), []
+    record = import_recorder(conn, payload['job_id'], progress, rows)
+    await fetch_import_rows_async(client, payload['isbns'], payload['owner_id'], record)
+    return insert_import_rows(conn, progress, rows)
+
+# ---------------- Sessions -----------------
+class ServerSession(SecureCookieSession):
+    # `user` holds the owner's id, username, role and approved flag as loaded with the session
+    def __init__(self, initial=None, sid=None, user=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.user = user
+        self.rotate = False
+
+    def regenerate(self):
+        # Issue a fresh id on login so a session id planted before it can't be reused
+        self.rotate = True
+        self.modified = True
+
+class SessionCache:
+    # LRU of sid -> (loaded_at, data, user, expires_at), indexed by user id for revocation
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._data.get(sid)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                return None
+            self._data.move_to_end(sid)
+            return entry
+
+    def put(self, sid, data, user, expires_at):
+        with self._lock:
+            self._discard(sid)
+            self._data[sid] = (time.monotonic(), data, user, expires_at)
+            if user:
+                self._by_user.setdefault(user['id'], set()).add(sid)
+            while len(self._data) > self.maxsize:
+                self._discard(next(iter(self._data)))
+
+    def _discard(self, sid):
+        entry = self._data.pop(sid, None)
+        if entry and entry[2]:
+            sids = self._by_user.get(entry[2]['id'])
+            if sids:
+                sids.discard(sid)
+                if not sids:
+                    del self._by_user[entry[2]['id']]
+
+    def discard(self, sid):
+        with self._lock:
+            self._discard(sid)
+
+    def revoke_user(self, user_id):
+        with self._lock:
+            for sid in list(self._by_user.get(user_id, ())):
+                self._discard(sid)
+
+    def __len__(self):
+        return len(self._data)
+
+_sessions = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+def session_user_row(row):
+    if row is None or row['id'] is None:
+        return None
+    return {'id': row['id'], 'username': row['username'], 'role': row['role'], 'approved': row['approved']}
+
+def load_session(sid):
+    # (data, user, expires_at) from the cache or one indexed join, else None
+    start = time.perf_counter()
+    entry = _sessions.get(sid)
+    outcome = 'cache'
+    if entry is None:
+        row = get_db().execute('''SELECT s.data, s.expires_at, u.id, u.username, u.role, u.approved
+                                  FROM sessions s LEFT JOIN users u ON u.id = s.user_id
+                                  WHERE s.id=?''', (sid,)).fetchone()
+        outcome = 'db' if row else 'miss'
+        if row is not None:
+            entry = (None, json.loads(row['data']), session_user_row(row), row['expires_at'])
+            _sessions.put(sid, *entry[1:])
+    observe('catalog_session_lookup_seconds', time.perf_counter() - start, LOOKUP_BUCKETS, outcome=outcome)
+    if entry is None or entry[3] < time.time():
+        return None
+    return entry[1:]
+
+def revoke_sessions(conn, user_id):
+    # Caller commits; this process stops honouring the sessions at once
+    conn.execute("DELETE FROM sessions WHERE user_id=?", (user_id,))
+    _sessions.revoke_user(user_id)
+
+def revoke_sessions_bulk(conn, user_ids):
+    conn.execute("DELETE FROM sessions WHERE user_id IN (SELECT value FROM json_each(?))", (json.dumps(user_ids),))
+    for user_id in user_ids:
+        _sessions.revoke_user(user_id)
+
+class SQLiteSessionInterface(SessionInterface):
+    def open_session(self, app, request):
+        # Public catalog pages never read the session; don't look one up for a signed-in visitor's
+        # cookie. The session is opened before URL matching, so this goes by path, not endpoint.
+        if request.path.startswith(PUBLIC_PATH_PREFIX):
+            return ServerSession()
+        sid = request.cookies.get(self.get_cookie_name(app))
+        loaded = load_session(sid) if sid else None
+        if loaded is None:
+            return ServerSession()
+        data, user, _ = loaded
+        return ServerSession(dict(data), sid=sid, user=user)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain, path = self.get_cookie_domain(app), self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not session.modified:
+            return
+        # Own connection, so a request that left a transaction open doesn't get it committed here
+        pool = get_pool()
+        conn = pool.acquire()
+        try:
+            if session.sid and (session.rotate or not session):
+                conn.execute("DELETE FROM sessions WHERE id=?", (session.sid,))
+                _sessions.discard(session.sid)
+                session.sid = None
+            if not session:
+                conn.commit()
+                response.delete_cookie(name, domain=domain, path=path)
+                return
+            session.sid = session.sid or secrets.token_urlsafe(32)
+            user_id = session.get('user_id')
+            if not user_id:
+                lifetime = ANON_SESSION_LIFETIME
+            elif session.permanent:
+                lifetime = app.permanent_session_lifetime.total_seconds()
+            else:
+                lifetime = BROWSER_SESSION_LIFETIME
+            now = time.time()
+            conn.execute('''INSERT INTO sessions (id, user_id, data, created_at, expires_at) VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT(id) DO UPDATE SET user_id=excluded.user_id, data=excluded.data,
+                                                          expires_at=excluded.expires_at''',
+                         (session.sid, user_id, json.dumps(dict(session)), now, now + lifetime))
+            user = session.user
+            if user_id and (user is None or user['id'] != user_id):
+                user = session_user_row(conn.execute(
+                    "SELECT id, username, role, approved FROM users WHERE id=?", (user_id,)).fetchone())
+            conn.commit()
+        finally:
+            pool.release(conn)
+        _sessions.put(session.sid, dict(session), user if user_id else None, now + lifetime)
+        # Like Flask's default interface, only a permanent session outlives the browser
+        expires = datetime.fromtimestamp(now + lifetime, timezone.utc) if session.permanent else None
+        response.set_cookie(name, session.sid, expires=expires,
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+app.session_interface = SQLiteSessionInterface()
 
 # ---------------- Auth -----------------
+def session_user():
+    # Attributes of the signed-in user, loaded with the session; no extra query
+    session.accessed = True
+    return getattr(session, 'user', None)
+
 def current_user():
-    return session.get('username')
+    user = session_user()
+    return user['username'] if user else None
+
+def current_user_id():
+    user = session_user()
+    return user['id'] if user else None
+
+def is_admin():
+    user = session_user()
+    return bool(user) and user['role'] == 'admin'
+
+def catalog_owner():
+    # owner_id whose books the current user sees; None means every owner (admin)
+    return None if is_admin() else current_user_id()
+
+def hash_password(password):
+    return generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])
+
+_hash_prefixes = {}
+
+def password_needs_rehash(stored):
+    # Compare against the "method:params" prefix werkzeug writes for the configured method,
+    # so a short spec like "pbkdf2:sha256" matches its expanded default iteration count
+    method = app.config['PASSWORD_HASH_METHOD']
+    prefix = _hash_prefixes.get(method)
+    if prefix is None:
+        prefix = _hash_prefixes[method] = generate_password_hash('', method=method).split('$', 1)[0]
+    return stored.split('$', 1)[0] != prefix
+
+class TokenBuckets:
+    # One bucket per key, refilled continuously; least recently used keys are dropped past
+    # `maxsize` so a spray of addresses or usernames can't grow memory without bound
+    def __init__(self, burst, per_minute, maxsize=LOGIN_BUCKETS):
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        # Seconds to wait before retrying, or 0 when a token was taken
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+_login_ip_buckets = TokenBuckets(LOGIN_IP_BURST, LOGIN_IP_PER_MINUTE)
+_login_user_buckets = TokenBuckets(LOGIN_USER_BURST, LOGIN_USER_PER_MINUTE)
+
+def login_throttle(username):
+    # Seconds until this client may try again; both buckets are charged before hashing
+    if not app.config['LOGIN_RATE_LIMIT']:
+        return 0
+    return max(_login_ip_buckets.take(request.remote_addr), _login_user_buckets.take(username or ''))
 
 def login_required(f):
     from functools import wraps
     @wraps(f)
     def decorated(*args, **kwargs):
-        if not current_user():
+        user = session_user()
+        # Approval is rechecked on every request, not only at login
+        if not user or not user['approved']:
+            if session.get('user_id'):
+                session.clear()
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated
@@ -70,86 +1709,390 @@ def admin_required(f):
     from functools import wraps
     @wraps(f)
     def decorated(*args, **kwargs):
-        if current_user() != 'admin':
+        if not is_admin():
             flash("Admin access required", "danger")
             return redirect(url_for('index'))
         return f(*args, **kwargs)
     return decorated
 
+# ---------------- Page Cache -----------------
+# Rendered book cards keyed by (owner, view params, catalog version). The version is bumped by
+# triggers on every insert/update/delete of an owner's books, so a stale entry is never looked
+# up again and simply ages out of the LRU.
+class PageCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.not_modified = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[0]
+            self._data[key] = (size, value)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                evicted_size, _ = self._data.popitem(last=False)[1]
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def count_not_modified(self):
+        # A 304 answered from the ETag alone, without fetching the entry
+        with self._lock:
+            self.not_modified += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'not_modified': self.not_modified,
+                    'evictions': self.evictions}
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+page_cache = PageCache(PAGE_CACHE_MAX_BYTES)
+
+def template_fingerprint():
+    # Folded into page ETags so a deploy with changed templates doesn't answer 304 with old markup
+    digest = hashlib.sha1()
+    for name in ('base.html', 'index.html', '_book_cards.html'):
+        with open(os.path.join(app.root_path, app.template_folder, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+_template_fingerprint = None
+
+def page_etag(key):
+    # Everything besides the cards that index.html renders from the session
+    global _template_fingerprint
+    if _template_fingerprint is None:
+        _template_fingerprint = template_fingerprint()
+    state = (key, _template_fingerprint, current_user(), bool(session.get('dark_mode')),
+             bool(session.get('mfa_setup')))
+    return hashlib.sha1(repr(state).encode()).hexdigest()
+
+def render_book_cards(conn, owner_id, q, in_library, cursor, facets=()):
+    # (cards_html, next_cursor, cacheable); cards still waiting on enrichment flip to done
+    # without a version bump when a job gives up, so pages showing them aren't cached
+    next_cursor = None
+    if q:
+        books = search_books(conn, q, owner_id)
+    else:
+        books, next_cursor = fetch_book_page(conn, owner_id, cursor, in_library=in_library, facets=facets)
+    books = with_job_state(conn, books)
+    html = render_template("_book_cards.html", books=books)
+    return html, next_cursor, not any(b['pending'] for b in books)
+
 # ---------------- Routes -----------------
 @app.route("/")
 @login_required
 def index():
+    q = request.args.get("q", "").strip()
+    in_library = request.args.get("in_library", type=int)
+    cursor = None if q else request.args.get("cursor")
+    facets = () if q else active_facets(request.args)
+    owner_id = catalog_owner()
     conn = get_db()
-    if current_user() == 'admin':
-        books = conn.execute("SELECT * FROM books").fetchall()
+    key = (owner_id, q, in_library, facets, cursor, catalog_version(conn, owner_id))
+    # Pending flash messages make the page one-off, so it gets neither an ETag nor a 304
+    etag = page_etag(key) if '_flashes' not in session else None
+    if etag and key in page_cache and request.if_none_match.contains(etag):
+        page_cache.count_not_modified()
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+
+    cached = page_cache.get(key)
+    if cached is None:
+        cards_html, next_cursor, cacheable = render_book_cards(conn, owner_id, q, in_library, cursor, facets)
+        if cacheable:
+            page_cache.put(key, (cards_html, next_cursor), len(cards_html))
+        else:
+            etag = None
     else:
-        books = conn.execute("SELECT * FROM books WHERE owner=?", (current_user(),)).fetchall()
-    conn.close()
-    return render_template("index.html", books=books, current_user=current_user())
+        cards_html, next_cursor = cached
+    resp = make_response(render_template("index.html", cards_html=Markup(cards_html), q=q, in_library=in_library,
+                                         filters=dict(facets), stats=facet_counts(conn, owner_id),
+                                         next_cursor=next_cursor, current_user=current_user()))
+    if etag:
+        resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+@app.route("/api/books")
+@login_required
+def api_books():
+    limit = max(1, min(request.args.get("limit", PAGE_SIZE, type=int), PAGE_SIZE))
+    conn = get_db()
+    books, next_cursor = fetch_book_page(conn, catalog_owner(), request.args.get("cursor"), limit,
+                                         request.args.get("in_library", type=int), active_facets(request.args))
+    return jsonify({"success": True, "books": with_job_state(conn, books), "next_cursor": next_cursor})
+
+@app.route("/api/facets")
+@login_required
+def api_facets():
+    limit = max(1, min(request.args.get("limit", FACET_LIMIT, type=int), FACET_MAX_LIMIT))
+    return jsonify({"success": True, **facet_counts(get_db(), catalog_owner(), limit)})
+
+@app.route("/api/books/status")
+@login_required
+def book_status():
+    # Polled by the catalog page for cards whose details are still being fetched
+    ids = [int(i) for i in request.args.get("ids", "").split(",") if i.isdigit()][:PAGE_SIZE]
+    owner_id = catalog_owner()
+    conn = get_db()
+    ids_json = json.dumps(ids)
+    books = {b['id']: b for b in conn.execute(
+        "SELECT * FROM books WHERE id IN (SELECT value FROM json_each(?))", (ids_json,)).fetchall()
+        if owner_id is None or b['owner_id'] == owner_id}
+    jobs = {}
+    for j in conn.execute('''SELECT book_id, owner, state, result FROM jobs
+                             WHERE book_id IN (SELECT value FROM json_each(?)) AND kind='enrich_book'
+                             ORDER BY id''', (ids_json,)).fetchall():
+        jobs[j['book_id']] = j
+    statuses = {}
+    for book_id in ids:
+        book, job = books.get(book_id), jobs.get(book_id)
+        if book is not None:
+            state = {'queued': 'pending', 'running': 'pending', 'failed': 'failed'}.get(job['state'] if job else None, 'ready')
+            statuses[book_id] = {"state": state, "book": dict(book)}
+        elif job and job['result'] and (owner_id is None or job['owner'] == current_user()):
+            if not json.loads(job['result'])['found']:
+                statuses[book_id] = {"state": "not_found", "book": None}
+    return jsonify({"success": True, "books": statuses})
+
+@app.route("/search")
+@login_required
+def search():
+    q = request.args.get("q", "").strip()
+    limit = max(1, min(request.args.get("limit", SEARCH_LIMIT, type=int), SEARCH_LIMIT))
+    conn = get_db()
+    books = search_books(conn, q, catalog_owner(), limit)
+    return jsonify({"success": True, "books": with_job_state(conn, books)})
 
 @app.route("/", methods=["POST"])
 @login_required
 def add_book():
-    isbn = request.form.get("isbn")
+    isbn = request.form.get("isbn", "").strip()
     if not isbn:
         flash("ISBN is required", "danger")
         return redirect(url_for('index'))
+    isbn13 = normalize_isbn(isbn)
     conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT * FROM books WHERE isbn=?", (isbn,))
+    c.execute("SELECT 1 FROM books WHERE isbn=? OR isbn13=?", (isbn, isbn13))
     if c.fetchone():
         flash("Book already exists", "warning")
-        conn.close()
         return redirect(url_for('index'))
 
-    resp = requests.get(f'https://www.googleapis.com/books/v1/volumes?q=isbn:{isbn}')
-    data = resp.json()
-    if 'items' not in data:
-        flash("Book not found via ISBN", "warning")
-        conn.close()
-        return redirect(url_for('index'))
-    info = data['items'][0]['volumeInfo']
-    title = info.get('title', '')
-    authors = ", ".join(info.get('authors', []))
-    publisher = info.get('publisher', '')
-    publishedDate = info.get('publishedDate', '')
-    cover_url = info.get('imageLinks', {}).get('thumbnail', '')
-
-    local_cover = None
-    if cover_url:
-        r = requests.get(cover_url)
-        if r.status_code == 200:
-            filename = f"{isbn}.jpg"
-            path = os.path.join(COVERS_DIR, filename)
-            with open(path, 'wb') as f:
-                f.write(r.content)
-            local_cover = filename
-
-    c.execute('''INSERT INTO books (title, authors, publisher, publishedDate, isbn, cover_url, owner)
-                 VALUES (?, ?, ?, ?, ?, ?, ?)''',
-              (title, authors, publisher, publishedDate, isbn, local_cover, current_user()))
-    conn.commit()
-    conn.close()
-    flash("Book added successfully", "success")
+    # Insert a placeholder now and let a job worker fill in the details from Google Books
+    with conn:
+        c.execute('''INSERT INTO books (title, authors, publisher, publishedDate, isbn, isbn13, owner_id)
+                     VALUES (?, '', '', '', ?, ?, ?)''', (isbn, isbn, isbn13, current_user_id()))
+        enqueue_job(conn, 'enrich_book', {'book_id': c.lastrowid, 'isbn': isbn},
+                    book_id=c.lastrowid, owner=current_user())
+    notify_job_workers()
+    flash("Book added, fetching details...", "success")
     return redirect(url_for('index'))
 
+@app.route("/api/books/batch", methods=["POST"])
+@login_required
+def add_books_batch():
+    # Continuous scan mode: a batch of scanned ISBNs in, one result per ISBN out. Everything
+    # is added in one transaction; the unique isbn/isbn13 indexes do the deduplication, so a
+    # concurrent add of the same book can't slip in between a check and the insert.
+    isbns, invalid = parse_isbn_upload(request)
+    if len(isbns) > BATCH_ADD_MAX:
+        return jsonify({"success": False, "message": f"At most {BATCH_ADD_MAX} ISBNs per batch"}), 413
+    results = [{"isbn": value, "status": "invalid"} for value in invalid]
+    conn = get_db()
+    with conn:
+        for isbn in isbns:
+            isbn13 = normalize_isbn(isbn)
+            if isbn13 is None:
+                results.append({"isbn": isbn, "status": "invalid"})
+                continue
+            rows = conn.execute('''INSERT OR IGNORE INTO books (title, authors, publisher, publishedDate, isbn, isbn13, owner_id)
+                                   VALUES (?, '', '', '', ?, ?, ?) RETURNING *''',
+                                (isbn, isbn, isbn13, current_user_id())).fetchall()
+            if not rows:
+                results.append({"isbn": isbn, "status": "duplicate"})
+                continue
+            book = dict(rows[0], pending=True)
+            enqueue_job(conn, 'enrich_book', {'book_id': book['id'], 'isbn': isbn},
+                        book_id=book['id'], owner=current_user())
+            results.append({"isbn": isbn, "status": "added", "book": book})
+    notify_job_workers()
+    return jsonify({"success": True, "results": results})
+
+@app.route("/import", methods=["POST"])
+@login_required
+def import_books():
+    isbns, invalid = parse_isbn_upload(request)
+    if not isbns:
+        return jsonify({"success": False, "message": "No valid ISBNs found", "invalid": invalid}), 400
+    conn = get_db()
+    existing = existing_isbns(conn, isbns)
+    new_isbns = [isbn for isbn in isbns if isbn not in existing]
+    job_id = start_import(conn, current_user(), current_user_id(), new_isbns, sorted(existing), invalid)
+    return jsonify({"success": True, "job_id": job_id, "total": len(isbns),
+                    "status_url": url_for('import_status', job_id=job_id)}), 202
+
+@app.route("/import/<int:job_id>")
+@login_required
+def import_status(job_id):
+    job = get_db().execute('''SELECT state, payload, result, last_error, created_at FROM jobs
+                              WHERE id=? AND kind='import_books' AND owner=?''', (job_id, current_user())).fetchone()
+    if not job:
+        return jsonify({"success": False, "message": "Import not found"}), 404
+    progress = json.loads(job['result']) if job['result'] else new_import_progress(json.loads(job['payload']))
+    # A job waiting for a retry is still running as far as the client is concerned
+    state = job['state'] if job['state'] in ('done', 'failed') else 'running'
+    if state == 'failed':
+        progress['errors'].append({'isbn': None, 'message': job['last_error']})
+    return jsonify({"success": True, "id": job_id, "state": state, "created": job['created_at'], **progress})
+
+@app.route("/metrics")
+def metrics():
+    if not app.config['METRICS']:
+        return "Not Found", 404
+    live = get_db().execute("SELECT COUNT(*) FROM sessions WHERE expires_at>=?", (time.time(),)).fetchone()[0]
+    gauges = {('catalog_sessions', (('store', 'cache'),)): len(_sessions),
+              ('catalog_sessions', (('store', 'db'),)): live}
+    return Response(render_metrics(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route("/isbn_cache/stats")
+@login_required
+@admin_required
+def isbn_cache_status():
+    conn = get_db()
+    row = conn.execute("SELECT COUNT(*) AS entries, COUNT(data) AS positive FROM isbn_cache").fetchone()
+    stats = isbn_cache_counts()
+    lookups = sum(stats.values()) - stats['negative_hits']
+    hits = lookups - stats['misses']
+    return jsonify({"success": True, **stats, "entries": row['entries'], "positive": row['positive'],
+                    "lru_entries": len(_isbn_lru), "hit_rate": round(hits / lookups, 4) if lookups else None})
+
+@app.route("/page_cache/stats")
+@login_required
+@admin_required
+def page_cache_status():
+    stats = page_cache.stats()
+    # A 304 is served from the cache too
+    served = stats['hits'] + stats['not_modified']
+    lookups = served + stats['misses']
+    return jsonify({"success": True, **stats, "entries": len(page_cache), "bytes": page_cache.bytes,
+                    "max_bytes": page_cache.max_bytes, "hit_rate": round(served / lookups, 4) if lookups else None})
+
+@app.route("/covers/<isbn>/<size>")
+def cover(isbn, size):
+    if size not in COVER_SIZES or not re.fullmatch(r'[0-9A-Za-z_-]+', isbn):
+        return "Not found", 404
+    formats = list(COVER_FORMATS) if request.accept_mimetypes['image/webp'] else ['jpg']
+    for fmt in formats:
+        path = cover_variant(isbn, size, fmt)
+        if path:
+            break
+    else:
+        return "Not found", 404
+    rv = send_file(os.path.abspath(path), mimetype=COVER_FORMATS[fmt][1], etag=file_etag(path),
+                   max_age=COVER_MAX_AGE, conditional=True)
+    rv.vary.add('Accept')
+    return rv
+
 @app.route("/toggle_in_library/<int:book_id>", methods=["POST"])
 @login_required
 def toggle_in_library(book_id):
     conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT in_library FROM books WHERE id=?", (book_id,))
-    book = c.fetchone()
-    if not book:
-        conn.close()
-        return jsonify({"success": False, "message": "Book not found"})
-    new_status = 0 if book['in_library'] else 1
-    c.execute("UPDATE books SET in_library=? WHERE id=?", (new_status, book_id))
+    # Flip in a single statement so the write lock is held as briefly as possible
+    c = conn.execute("UPDATE books SET in_library = NOT in_library WHERE id=?", (book_id,))
     conn.commit()
-    conn.close()
+    if not c.rowcount:
+        return jsonify({"success": False, "message": "Book not found"})
     return jsonify({"success": True})
 
+# ---------------- Public Catalog -----------------
+# Read-only /u/<username> pages for anonymous traffic. Both renderings are built once per
+# catalog version and served as bytes with a content ETag. open_session skips the session lookup
+# under PUBLIC_PATH_PREFIX even when a cookie is sent, so responses carry no Vary: Cookie and a
+# CDN can cache them.
+PUBLIC_FIELDS = ('title', 'authors', 'publisher', 'publishedDate', 'isbn', 'in_library')
+_public_snapshots = PageCache(PUBLIC_SNAPSHOT_MAX_BYTES)
+# Striped by username so memory stays fixed however many owners are requested
+_public_build_locks = [threading.Lock() for _ in range(PUBLIC_BUILD_LOCKS)]
+
+def public_owner(conn, username):
+    return conn.execute('''SELECT u.id, COALESCE(v.version, 0) AS version FROM users u
+                           LEFT JOIN catalog_versions v ON v.owner_id = u.id
+                           WHERE u.username=? AND u.approved=1''', (username,)).fetchone()
+
+def build_public_snapshot(conn, username, owner_id, version):
+    books = [dict(b) for b in conn.execute(
+        f"SELECT {', '.join(PUBLIC_FIELDS)} FROM books WHERE owner_id=? ORDER BY title, id", (owner_id,))]
+    html = render_template("public_catalog.html", username=username, books=books, session={}).encode()
+    body = json.dumps({"username": username, "books": books}, separators=(',', ':')).encode()
+    return {
+        'key': (owner_id, version),
+        'html': (html, hashlib.sha1(html).hexdigest()),
+        'json': (body, hashlib.sha1(body).hexdigest()),
+    }
+
+def public_snapshot(username):
+    # Regenerated only when the owner's catalog version has moved on
+    conn = get_db()
+    owner = public_owner(conn, username)
+    if owner is None:
+        return None
+    def current(snapshot):
+        return snapshot is not None and snapshot['key'][0] == owner['id'] and snapshot['key'][1] >= owner['version']
+
+    snapshot = _public_snapshots.get(username)
+    if current(snapshot):
+        return snapshot
+    # One rebuild per owner at a time; requests that arrived during it reuse the result
+    with _public_build_locks[hash(username) % PUBLIC_BUILD_LOCKS]:
+        snapshot = _public_snapshots.get(username)
+        if not current(snapshot):
+            snapshot = build_public_snapshot(conn, username, owner['id'], owner['version'])
+            _public_snapshots.put(username, snapshot, len(snapshot['html'][0]) + len(snapshot['json'][0]))
+    return snapshot
+
+def public_response(username, kind, mimetype):
+    snapshot = public_snapshot(username)
+    if snapshot is None:
+        return "Not found", 404
+    body, etag = snapshot[kind]
+    resp = Response(body, mimetype=mimetype)
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = PUBLIC_MAX_AGE
+    return resp.make_conditional(request)
+
+@app.route(PUBLIC_PATH_PREFIX + "<username>")
+def public_catalog(username):
+    return public_response(username, 'html', 'text/html')
+
+@app.route(PUBLIC_PATH_PREFIX + "<username>.json")
+def public_catalog_json(username):
+    return public_response(username, 'json', 'application/json')
+
 # ---------------- User Auth -----------------
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -157,20 +2100,37 @@ def login():
         username = request.form.get("username")
         password = request.form.get("password")
         token = request.form.get("token")
+        retry_after = login_throttle(username)
+        if retry_after:
+            count('catalog_login_attempts_total', outcome='throttled')
+            flash("Too many login attempts, try again shortly", "danger")
+            resp = make_response(render_template("login.html"), 429)
+            resp.headers['Retry-After'] = str(int(retry_after) + 1)
+            return resp
         conn = get_db()
-        user = conn.execute("SELECT * FROM users WHERE username=?", (username,)).fetchone()
-        conn.close()
-        if not user or not check_password_hash(user['password'], password):
+        user = conn.execute("SELECT id, password, approved, mfa_secret FROM users WHERE username=?",
+                            (username,)).fetchone()
+        if not user or not check_password_hash(user['password'], password or ''):
+            count('catalog_login_attempts_total', outcome='invalid')
             flash("Invalid credentials", "danger")
             return redirect(url_for('login'))
         if not user['approved']:
             flash("User not approved by admin", "warning")
             return redirect(url_for('login'))
         if user['mfa_secret']:
+            import pyotp
             if not token or not pyotp.TOTP(user['mfa_secret']).verify(token):
+                count('catalog_login_attempts_total', outcome='invalid_mfa')
                 flash("Invalid MFA token", "danger")
                 return redirect(url_for('login'))
+        if password_needs_rehash(user['password']):
+            conn.execute("UPDATE users SET password=? WHERE id=?", (hash_password(password), user['id']))
+            conn.commit()
+        _login_user_buckets.reset(username)
+        count('catalog_login_attempts_total', outcome='success')
+        session.regenerate()
         session['username'] = username
+        session['user_id'] = user['id']
         flash("Login successful", "success")
         return redirect(url_for('index'))
     return render_template("login.html")
@@ -195,14 +2155,12 @@ def register():
         c = conn.cursor()
         if c.execute("SELECT * FROM users WHERE username=?", (username,)).fetchone():
             flash("Username already exists", "warning")
-            conn.close()
             return redirect(url_for('register'))
 
         # New users pending admin approval
         c.execute("INSERT INTO users (username, password) VALUES (?, ?)",
-                  (username, generate_password_hash(password)))
+                  (username, hash_password(password)))
         conn.commit()
-        conn.close()
         flash("Registration submitted! Wait for admin approval.", "success")
         return redirect(url_for('login'))
 
@@ -230,13 +2188,11 @@ def change_password():
         user = c.execute("SELECT * FROM users WHERE username=?", (current_user(),)).fetchone()
         if not check_password_hash(user['password'], current_pass):
             flash("Current password incorrect", "danger")
-            conn.close()
             return redirect(url_for('change_password'))
 
         c.execute("UPDATE users SET password=? WHERE username=?",
-                  (generate_password_hash(new_pass), current_user()))
+                  (hash_password(new_pass), current_user()))
         conn.commit()
-        conn.close()
         flash("Password changed successfully", "success")
         return redirect(url_for('index'))
 
@@ -246,6 +2202,8 @@ def change_password():
 @app.route("/setup_mfa", methods=["GET", "POST"])
 @login_required
 def setup_mfa():
+    import pyotp
+    import qrcode
     conn = get_db()
     c = conn.cursor()
     user = c.execute("SELECT * FROM users WHERE username=?", (current_user(),)).fetchone()
@@ -283,54 +2241,312 @@ def set_dark_mode():
     return '', 204
 
 # ---------------- Export -----------------
+# Column key -> (CSV header, formatter); the default export includes all of them in this order
+CSV_FIELDS = {
+    'title': ('Title', lambda b: b['title']),
+    'authors': ('Authors', lambda b: b['authors']),
+    'publisher': ('Publisher', lambda b: b['publisher']),
+    'publishedDate': ('Published', lambda b: b['publishedDate']),
+    'isbn': ('ISBN', lambda b: b['isbn']),
+    'in_library': ('In Library', lambda b: 'Yes' if b['in_library'] else 'No'),
+}
+
+def csv_chunks(books, fields):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([CSV_FIELDS[f][0] for f in fields])
+    # Send the header straight away so the download starts before the first query batch
+    yield buf.getvalue().encode('utf-8')
+    buf.seek(0)
+    buf.truncate()
+    for i, b in enumerate(books, 1):
+        writer.writerow([CSV_FIELDS[f][1](b) for f in fields])
+        if i % EXPORT_BATCH_SIZE == 0:
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode('utf-8')
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
 @app.route("/export_csv")
 @login_required
 def export_csv():
-    conn = get_db()
-    if current_user() == 'admin':
-        books = conn.execute("SELECT * FROM books").fetchall()
-    else:
-        books = conn.execute("SELECT * FROM books WHERE owner=?", (current_user(),)).fetchall()
-    conn.close()
-    si = BytesIO()
-    writer = csv.writer(si)
-    writer.writerow(['Title','Authors','Publisher','Published','ISBN','In Library'])
+    owner_id = catalog_owner()
+    fields = [f for f in request.args.get("fields", "").split(",") if f in CSV_FIELDS] or list(CSV_FIELDS)
+    compress = request.args.get("gzip") == "1"
+
+    def generate():
+        chunks = csv_chunks(iter_books(get_db(), owner_id), fields)
+        yield from gzip_chunks(chunks) if compress else chunks
+
+    filename = 'library.csv.gz' if compress else 'library.csv'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/gzip' if compress else 'text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+# PDF exports are rendered by a job worker into EXPORTS_DIR, one file per owner and catalog
+# version, so a finished export is reused until that owner's books change.
+def pdf_export_prefix(owner_id):
+    return f"catalog-{'all' if owner_id is None else owner_id}-v"
+
+def pdf_export_path(owner_id, version):
+    return os.path.join(EXPORTS_DIR, f"{pdf_export_prefix(owner_id)}{version}.pdf")
+
+def pdf_text(value):
+    # The core PDF fonts only cover latin-1
+    return str(value or '').encode('latin-1', 'replace').decode('latin-1')
+
+def fit_text(pdf, text, width):
+    text = pdf_text(text)
+    if pdf.get_string_width(text) <= width:
+        return text
+    while text and pdf.get_string_width(text + '...') > width:
+        text = text[:-1]
+    return text + '...'
+
+def cover_thumbnail(filename):
+    # The JPEG thumb variant from the cover pipeline; FPDF can't embed WebP
+    if not filename:
+        return None
+    return cover_variant(os.path.splitext(filename)[0], 'thumb', 'jpg')
+
+# (header, width in mm, row field); the first column holds the cover thumbnail
+PDF_COLUMNS = [
+    ('', 10, None),
+    ('Title', 68, 'title'),
+    ('Authors', 50, 'authors'),
+    ('Year', 14, 'publishedDate'),
+    ('ISBN', 32, 'isbn'),
+    ('In', 16, 'in_library'),
+]
+PDF_ROW_HEIGHT = 13
+
+def render_catalog_pdf(books, path):
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.set_auto_page_break(False)
+    pdf.set_margins(10, 10)
+
+    def header():
+        pdf.add_page()
+        pdf.set_font("Arial", "B", 14)
+        pdf.cell(0, 10, "Library Catalog", 0, 1, 'C')
+        pdf.set_font("Arial", "B", 9)
+        for title, width, _ in PDF_COLUMNS:
+            pdf.cell(width, 7, title, 'B')
+        pdf.ln()
+        pdf.set_font("Arial", "", 9)
+
+    header()
     for b in books:
-        writer.writerow([b['title'], b['authors'], b['publisher'], b['publishedDate'], b['isbn'], 'Yes' if b['in_library'] else 'No'])
-    si.seek(0)
-    return send_file(si, mimetype='text/csv', download_name='library.csv', as_attachment=True)
+        if pdf.get_y() + PDF_ROW_HEIGHT > pdf.h - 10:
+            header()
+        y = pdf.get_y()
+        thumb = cover_thumbnail(b['cover_url'])
+        if thumb:
+            pdf.image(thumb, 11, y + 1, 0, PDF_ROW_HEIGHT - 2)
+        pdf.set_x(10 + PDF_COLUMNS[0][1])
+        for _, width, field in PDF_COLUMNS[1:]:
+            if field == 'in_library':
+                text = 'Yes' if b['in_library'] else 'No'
+            elif field == 'publishedDate':
+                text = (b['publishedDate'] or '')[:4]
+            else:
+                text = fit_text(pdf, b[field], width - 2)
+            pdf.cell(width, PDF_ROW_HEIGHT, text)
+        pdf.ln()
+
+    os.makedirs(EXPORTS_DIR, exist_ok=True)
+    pdf.output(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+@job_handler('export_pdf')
+def export_pdf_job(payload):
+    owner_id, version = payload['owner_id'], payload['version']
+    path = pdf_export_path(owner_id, version)
+    if not os.path.exists(path):
+        render_catalog_pdf(iter_books(get_db(), owner_id), path)
+    # Older versions of this owner's export are stale now
+    prefix = pdf_export_prefix(owner_id)
+    for name in os.listdir(EXPORTS_DIR):
+        if name.startswith(prefix) and name != os.path.basename(path):
+            os.remove(os.path.join(EXPORTS_DIR, name))
+    return {'path': path}
 
 @app.route("/export_pdf")
 @login_required
 def export_pdf():
+    owner_id = catalog_owner()
     conn = get_db()
-    if current_user() == 'admin':
-        books = conn.execute("SELECT * FROM books").fetchall()
+    version = catalog_version(conn, owner_id)
+    path = pdf_export_path(owner_id, version)
+    if os.path.exists(path):
+        return send_file(os.path.abspath(path), mimetype='application/pdf', download_name='library.pdf', as_attachment=True)
+    job = conn.execute('''SELECT id FROM jobs WHERE kind='export_pdf' AND owner=? AND state IN ('queued', 'running')
+                          AND json_extract(payload, '$.version')=?''', (current_user(), version)).fetchone()
+    if job:
+        job_id = job['id']
     else:
-        books = conn.execute("SELECT * FROM books WHERE owner=?", (current_user(),)).fetchall()
-    conn.close()
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", "B", 14)
-    pdf.cell(0, 10, "Library Catalog", ln=True, align='C')
-    pdf.set_font("Arial", "", 12)
-    for b in books:
-        pdf.ln(5)
-        pdf.multi_cell(0, 6, f"Title: {b['title']}\nAuthors: {b['authors']}\nPublisher: {b['publisher']}\nPublished: {b['publishedDate']}\nISBN: {b['isbn']}\nIn Library: {'Yes' if b['in_library'] else 'No'}")
-    out = BytesIO()
-    pdf.output(out)
-    out.seek(0)
-    return send_file(out, mimetype='application/pdf', download_name='library.pdf', as_attachment=True)
+        with conn:
+            job_id = enqueue_job(conn, 'export_pdf', {'owner_id': owner_id, 'version': version}, owner=current_user())
+        notify_job_workers()
+    return render_template("export_pdf.html", job_id=job_id)
+
+@app.route("/export_pdf/<int:job_id>")
+@login_required
+def export_pdf_status(job_id):
+    job = get_db().execute("SELECT state, result FROM jobs WHERE id=? AND kind='export_pdf' AND owner=?",
+                           (job_id, current_user())).fetchone()
+    if not job:
+        return jsonify({"success": False, "message": "Export not found"}), 404
+    download_url = url_for('export_pdf_download', job_id=job_id) if job['state'] == 'done' else None
+    return jsonify({"success": True, "state": job['state'], "download_url": download_url})
+
+@app.route("/export_pdf/<int:job_id>/download")
+@login_required
+def export_pdf_download(job_id):
+    job = get_db().execute("SELECT result FROM jobs WHERE id=? AND kind='export_pdf' AND owner=? AND state='done'",
+                           (job_id, current_user())).fetchone()
+    path = json.loads(job['result'])['path'] if job else None
+    if not path or not os.path.exists(path):
+        flash("That export has expired, generating a fresh one", "warning")
+        return redirect(url_for('export_pdf'))
+    return send_file(os.path.abspath(path), mimetype='application/pdf', download_name='library.pdf', as_attachment=True)
+
+# ---------------- Sync -----------------
+# /api/changes?since=<version> streams, oldest first, one NDJSON line per change after
+# `since`: {"op":"upsert","version":V,"book":{...}} or {"op":"delete","version":V,"id":N},
+# then {"op":"end","version":V} whose V is the `since` for the next call. A `since` older
+# than the pruned tombstones gets {"op":"reset"} followed by the whole catalog.
+SYNC_FIELDS = "id, title, authors, publisher, publishedDate, isbn, isbn13, cover_url, in_library, owner_id, version"
+
+def change_events(conn, owner_id, since):
+    # A single read transaction, so rows, tombstones and the end version are one snapshot
+    conn.execute("BEGIN")
+    try:
+        counter = conn.execute("SELECT version, pruned FROM sync_counter").fetchone()
+        reset = since < counter['pruned']
+        if reset:
+            yield {'op': 'reset'}
+            since = 0
+        if owner_id is None:
+            books = conn.execute(f"SELECT {SYNC_FIELDS} FROM books WHERE version>? ORDER BY version", (since,))
+            # A book moving between owners is still in the all-owners catalog
+            tombstones = conn.execute('''SELECT book_id, version FROM book_tombstones
+                                         WHERE version>? AND NOT moved ORDER BY version''', (since,))
+        else:
+            books = conn.execute(f'''SELECT {SYNC_FIELDS} FROM books WHERE owner_id=? AND version>?
+                                     ORDER BY version''', (owner_id, since))
+            tombstones = conn.execute('''SELECT book_id, version FROM book_tombstones
+                                         WHERE owner_id=? AND version>? ORDER BY version''', (owner_id, since))
+        upserts = ({'op': 'upsert', 'version': b['version'],
+                    'book': {k: b[k] for k in b.keys() if k != 'version'}} for b in books)
+        deletes = () if reset else ({'op': 'delete', 'version': t['version'], 'id': t['book_id']} for t in tombstones)
+        yield from heapq.merge(upserts, deletes, key=lambda e: e['version'])
+        yield {'op': 'end', 'version': counter['version']}
+    finally:
+        conn.rollback()
+
+def ndjson_chunks(events):
+    lines = []
+    for event in events:
+        lines.append(json.dumps(event, separators=(',', ':')))
+        if len(lines) == EXPORT_BATCH_SIZE:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+@app.route("/api/changes")
+@login_required
+def api_changes():
+    since = max(0, request.args.get("since", 0, type=int))
+    owner_id = catalog_owner()
+    compress = request.accept_encodings['gzip'] > 0
+
+    def generate():
+        chunks = ndjson_chunks(change_events(get_db(), owner_id, since))
+        yield from gzip_chunks(chunks) if compress else chunks
+
+    resp = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    resp.vary.add('Accept-Encoding')
+    if compress:
+        resp.headers['Content-Encoding'] = 'gzip'
+    return resp
 
 # ---------------- User Management -----------------
+# The admin page pages through users by (username, id) and never selects password hashes or
+# MFA secrets. Bulk actions take {"ids": [...]} and apply the whole list in one transaction;
+# admins are always skipped.
+USERS_PAGE_SIZE = 50
+USER_BULK_MAX = 1000
+# Every reset hashes a new password, which is deliberately slow
+RESET_BULK_MAX = 100
+TEMP_PASSWORD_BYTES = 9
+
+def fetch_user_page(conn, q='', status=None, cursor=None, limit=USERS_PAGE_SIZE):
+    clauses, params = [], []
+    if status is not None:
+        clauses.append("u.approved=?")
+        params.append(status)
+    if q:
+        # Prefix match as a range, so it stays on the username index
+        clauses.append("u.username >= ? AND u.username < ?")
+        params.extend((q, q + '\uffff'))
+    after = decode_cursor(cursor) if cursor else None
+    if after:
+        clauses.append("(u.username, u.id) > (?, ?)")
+        params.extend(after)
+    sql = '''SELECT u.id, u.username, u.approved, u.role, u.mfa_secret IS NOT NULL AS mfa,
+                    (SELECT COALESCE(SUM(count), 0) FROM facet_counts
+                     WHERE owner_id=u.id AND facet='in_library') AS books
+             FROM users u'''
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY u.username, u.id LIMIT ?"
+    params.append(limit + 1)
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = encode_cursor(rows[limit - 1], 'username') if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def bulk_user_ids(conn, ids, limit=USER_BULK_MAX):
+    # Existing non-admin users among `ids`, or None if the list is malformed or too long
+    if not isinstance(ids, list) or len(ids) > limit or not all(isinstance(i, int) for i in ids):
+        return None
+    rows = conn.execute("SELECT id FROM users WHERE id IN (SELECT value FROM json_each(?)) AND role!='admin'",
+                        (json.dumps(ids),)).fetchall()
+    return [r['id'] for r in rows]
+
+def delete_users(conn, user_ids, books='reassign', reassign_to=None):
+    # Caller commits. The users' books go to `reassign_to` or are deleted with them; either
+    # way it's one statement, and the book triggers keep facets and the change log in step.
+    ids_json = json.dumps(user_ids)
+    if books == 'delete':
+        c = conn.execute("DELETE FROM books WHERE owner_id IN (SELECT value FROM json_each(?))", (ids_json,))
+    else:
+        c = conn.execute("UPDATE books SET owner_id=? WHERE owner_id IN (SELECT value FROM json_each(?))",
+                         (reassign_to, ids_json))
+    revoke_sessions_bulk(conn, user_ids)
+    conn.execute("DELETE FROM users WHERE id IN (SELECT value FROM json_each(?))", (ids_json,))
+    return c.rowcount
+
 @app.route("/user_management")
 @login_required
 @admin_required
 def user_management():
-    conn = get_db()
-    users = conn.execute("SELECT * FROM users").fetchall()
-    conn.close()
-    return render_template("user_management.html", users=users)
+    q = request.args.get("q", "").strip()
+    status = request.args.get("status")
+    approved = {'pending': 0, 'approved': 1}.get(status)
+    users, next_cursor = fetch_user_page(get_db(), q, approved, request.args.get("cursor"))
+    return render_template("user_management.html", users=users, next_cursor=next_cursor, q=q, status=status)
 
 @app.route("/approve_user/<int:user_id>", methods=["POST"])
 @login_required
@@ -340,24 +2556,58 @@ def approve_user(user_id):
     c = conn.cursor()
     c.execute("UPDATE users SET approved=1 WHERE id=?", (user_id,))
     conn.commit()
-    conn.close()
     return jsonify({"success": True})
 
+@app.route("/approve_users", methods=["POST"])
+@login_required
+@admin_required
+def approve_users():
+    ids = (request.get_json(silent=True) or {}).get("ids")
+    if not isinstance(ids, list) or len(ids) > USER_BULK_MAX:
+        return jsonify({"success": False, "message": f"Expected up to {USER_BULK_MAX} user ids"}), 400
+    conn = get_db()
+    with conn:
+        c = conn.execute("UPDATE users SET approved=1 WHERE id IN (SELECT value FROM json_each(?)) AND approved=0",
+                         (json.dumps(ids),))
+    return jsonify({"success": True, "approved": c.rowcount})
+
 @app.route("/delete_user/<int:user_id>", methods=["POST"])
 @login_required
 @admin_required
 def delete_user(user_id):
     conn = get_db()
     c = conn.cursor()
-    user = c.execute("SELECT username FROM users WHERE id=?", (user_id,)).fetchone()
-    if user and user['username'] != 'admin':
-        c.execute("DELETE FROM users WHERE id=?", (user_id,))
+    user = c.execute("SELECT role FROM users WHERE id=?", (user_id,)).fetchone()
+    if user and user['role'] != 'admin':
+        books = 'delete' if request.form.get("books") == 'delete' else 'reassign'
+        delete_users(conn, [user_id], books, current_user_id())
         conn.commit()
-        conn.close()
         return jsonify({"success": True})
-    conn.close()
     return jsonify({"success": False, "message": "Cannot delete admin"})
 
+@app.route("/delete_users", methods=["POST"])
+@login_required
+@admin_required
+def delete_users_bulk():
+    # {"ids": [...], "books": "reassign" | "delete", "reassign_to": <user id, default: you>}
+    data = request.get_json(silent=True) or {}
+    books = data.get("books", "reassign")
+    if books not in ("reassign", "delete"):
+        return jsonify({"success": False, "message": "books must be 'reassign' or 'delete'"}), 400
+    conn = get_db()
+    with conn:
+        user_ids = bulk_user_ids(conn, data.get("ids"))
+        if user_ids is None:
+            return jsonify({"success": False, "message": f"Expected up to {USER_BULK_MAX} user ids"}), 400
+        reassign_to = data.get("reassign_to", current_user_id())
+        if books == "reassign":
+            keeps = isinstance(reassign_to, int) and reassign_to not in user_ids
+            if not keeps or conn.execute("SELECT 1 FROM users WHERE id=?", (reassign_to,)).fetchone() is None:
+                return jsonify({"success": False, "message": "reassign_to must be a user who is being kept"}), 400
+        moved = delete_users(conn, user_ids, books, reassign_to)
+    return jsonify({"success": True, "deleted": len(user_ids),
+                    "books_deleted" if books == "delete" else "books_reassigned": moved})
+
 @app.route("/reset_password/<int:user_id>", methods=["POST"])
 @login_required
 @admin_required
@@ -367,12 +2617,41 @@ def reset_password(user_id):
         return jsonify({"success": False, "message": "Password required"})
     conn = get_db()
     c = conn.cursor()
-    c.execute("UPDATE users SET password=? WHERE id=?", (generate_password_hash(new_password), user_id))
+    c.execute("UPDATE users SET password=? WHERE id=?", (hash_password(new_password), user_id))
+    revoke_sessions(conn, user_id)
     conn.commit()
-    conn.close()
     return jsonify({"success": True})
 
+@app.route("/reset_passwords", methods=["POST"])
+@login_required
+@admin_required
+def reset_passwords():
+    # Each user gets their own random temporary password, returned once in the response
+    data = request.get_json(silent=True) or {}
+    conn = get_db()
+    user_ids = bulk_user_ids(conn, data.get("ids"), RESET_BULK_MAX)
+    if user_ids is None:
+        return jsonify({"success": False, "message": f"Expected up to {RESET_BULK_MAX} user ids"}), 400
+    passwords = {user_id: secrets.token_urlsafe(TEMP_PASSWORD_BYTES) for user_id in user_ids}
+    # Hash before taking the write lock, so the transaction itself is short
+    hashes = [(hash_password(password), user_id) for user_id, password in passwords.items()]
+    with conn:
+        conn.executemany("UPDATE users SET password=? WHERE id=?", hashes)
+        revoke_sessions_bulk(conn, user_ids)
+    return jsonify({"success": True, "passwords": passwords})
+
+def configure_app(config=None):
+    # Applies config overrides to this module's app and returns it, without touching the database,
+    # the filesystem or the PDF/MFA/HTTP client libraries. Not a factory: routes, caches and pools
+    # are module-level, so every caller gets the same app and the last config wins.
+    if config:
+        app.config.update(config)
+    return app
+
 # ---------------- Run App -----------------
 if __name__ == "__main__":
+    init_db()
+    # Resume any jobs left queued or running by the previous process
+    start_job_workers()
     #app.run(debug=True)
     app.run(ssl_context=('cert.pem', 'key.pem'), host='0.0.0.0', port=5000)
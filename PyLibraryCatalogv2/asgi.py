@@ -0,0 +1,68 @@
+"""Production entry point: the catalog under uvicorn, with Google Books traffic on asyncio.
+
+    pip install uvicorn a2wsgi httpx
+    python3 asgi.py --workers 4                 # TLS from cert.pem/key.pem like app.py
+    flask --app app init-db && uvicorn asgi:application --workers 4
+                                                # or behind a TLS-terminating proxy
+
+Flask views stay synchronous (a2wsgi runs them on a bounded thread pool), but none of them call
+Google Books: enrichment jobs and bulk imports run on one event loop per worker process with
+httpx, so a slow upstream holds sockets rather than threads. Jobs are claimed atomically
+from the jobs table, so any number of workers can share the queue.
+"""
+import argparse
+import os
+
+from a2wsgi import WSGIMiddleware
+
+import app as catalog
+
+WSGI_THREADS = 16
+
+
+class CatalogASGI:
+    # Applies `config` on the first event a worker process sees and starts the job loop from
+    # the lifespan event, so neither happens in the launcher (or a test) that only imports this
+    def __init__(self, wsgi_app, config):
+        self.http = WSGIMiddleware(wsgi_app, workers=WSGI_THREADS)
+        self.config = config
+        self.configured = False
+
+    async def __call__(self, scope, receive, send):
+        if not self.configured:
+            catalog.configure_app(self.config)
+            self.configured = True
+        if scope['type'] != 'lifespan':
+            return await self.http(scope, receive, send)
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                catalog.start_job_workers()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = CatalogASGI(catalog.app, {'ASYNC_JOBS': True})
+
+
+def main():
+    import uvicorn
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--certfile", default="cert.pem")
+    parser.add_argument("--keyfile", default="key.pem")
+    parser.add_argument("--no-tls", action="store_true", help="plain HTTP, e.g. behind a proxy")
+    args = parser.parse_args()
+    tls = {} if args.no_tls else {'ssl_certfile': args.certfile, 'ssl_keyfile': args.keyfile}
+    # Migrate once here rather than in every worker
+    catalog.init_db()
+    uvicorn.run("asgi:application", host=args.host, port=args.port, workers=args.workers,
+                app_dir=os.path.dirname(os.path.abspath(__file__)), **tls)
+
+
+if __name__ == "__main__":
+    main()
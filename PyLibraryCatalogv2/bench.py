@@ -0,0 +1,797 @@
+"""Benchmarks for PyLibraryCatalogv2.
+
+Run from this directory, e.g.:
+
+    python3 bench.py db --threads 8 --ops 2000
+    python3 bench.py plans
+    python3 bench.py metrics
+    python3 bench.py load --sizes 1k,100k,1M --owners 200 --clients 16
+    python3 bench.py login --seconds 10 --clients 4 --attackers 16
+    python3 bench.py enrich --jobs 2000 --latency-ms 200
+    python3 bench.py load --server asgi --workers 4 --endpoints index,api_books,add_book
+    python3 bench.py startup --runs 10
+
+Each scenario prints one JSON document to stdout.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_app(workdir):
+    # library.db, static/covers and exports are relative to the cwd
+    os.chdir(workdir)
+    sys.path.insert(0, HERE)
+    import app
+    app.init_db()
+    return app
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies, elapsed, errors=0):
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+    }
+
+
+def seed_books(conn, owner, count, owner_column='owner_id'):
+    conn.executemany(
+        f"INSERT INTO books (title, authors, publisher, publishedDate, isbn, {owner_column}) VALUES (?, ?, ?, ?, ?, ?)",
+        ((f"Title {i:07d}", f"Author {i % 997}", f"Publisher {i % 89}", str(1900 + i % 120),
+          f"{owner}-{i}", owner) for i in range(count)))
+    conn.commit()
+
+
+# ---------------- db: connect-per-request vs pooled connections -----------------
+def run_db_workload(acquire, release, threads, ops, write_ratio, book_count, owner, owner_column):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        local = []
+        for _ in range(ops):
+            start = time.perf_counter()
+            conn = acquire()
+            try:
+                if rnd.random() < write_ratio:
+                    conn.execute("UPDATE books SET in_library = NOT in_library WHERE id=?",
+                                 (rnd.randint(1, book_count),))
+                    conn.commit()
+                else:
+                    conn.execute(f"SELECT * FROM books WHERE {owner_column}=? ORDER BY title, id LIMIT 48",
+                                 (owner,)).fetchall()
+            except sqlite3.OperationalError:
+                with lock:
+                    errors[0] += 1
+            finally:
+                release(conn)
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return summarize(latencies, time.perf_counter() - start, errors[0])
+
+
+def bench_db(args):
+    workdir = tempfile.mkdtemp(prefix="catalog-bench-")
+    app = load_app(workdir)
+
+    # Baseline: the original get_db(), a fresh rollback-journal connection per request
+    legacy_path = os.path.join(workdir, "legacy.db")
+    conn = sqlite3.connect(legacy_path)
+    conn.execute("CREATE TABLE books (id INTEGER PRIMARY KEY, title TEXT, authors TEXT, publisher TEXT, "
+                 "publishedDate TEXT, isbn TEXT UNIQUE, cover_url TEXT, in_library INTEGER DEFAULT 1, owner TEXT)")
+    seed_books(conn, 'bench', args.books, 'owner')
+    conn.close()
+
+    def legacy_acquire():
+        c = sqlite3.connect(legacy_path)
+        c.row_factory = sqlite3.Row
+        return c
+
+    # Pooled: the same workload through app.ConnectionPool
+    pool = app.get_pool()
+    conn = pool.acquire()
+    seed_books(conn, 1, args.books)
+    pool.release(conn)
+
+    results = {
+        "scenario": "db",
+        "threads": args.threads,
+        "ops_per_thread": args.ops,
+        "write_ratio": args.write_ratio,
+        "books": args.books,
+        "connect_per_request": run_db_workload(legacy_acquire, lambda c: c.close(), args.threads,
+                                               args.ops, args.write_ratio, args.books, 'bench', 'owner'),
+        "pooled_wal": run_db_workload(pool.acquire, pool.release, args.threads,
+                                      args.ops, args.write_ratio, args.books, 1, 'owner_id'),
+    }
+    print(json.dumps(results, indent=2))
+
+
+# ---------------- plans: hot queries must be served by an index -----------------
+class RecordingConnection:
+    # Passes execute() through to sqlite3 and remembers each statement and its parameters
+    def __init__(self, conn):
+        self.conn = conn
+        self.statements = []
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, params))
+        return self.conn.execute(sql, params)
+
+    def rollback(self):
+        self.conn.rollback()
+
+
+# A full table scan, or sorting rows after the fact, means an index is missing
+BAD_PLAN = re.compile(r"^SCAN (books|b|book_tombstones|u)$|USE TEMP B-TREE FOR ORDER BY")
+
+
+def bench_plans(args):
+    workdir = tempfile.mkdtemp(prefix="catalog-plans-")
+    app = load_app(workdir)
+    with app.app.app_context():
+        conn = app.get_db()
+        seed_books(conn, 1, 2000)
+        conn.execute("ANALYZE")
+        _, cursor = app.fetch_book_page(conn, 1)
+
+        hot_paths = {
+            "catalog_page": lambda c: app.fetch_book_page(c, 1),
+            "catalog_page_cursor": lambda c: app.fetch_book_page(c, 1, cursor),
+            "catalog_page_in_library": lambda c: app.fetch_book_page(c, 1, in_library=0),
+            "catalog_page_all_owners": lambda c: app.fetch_book_page(c, None, cursor),
+            "export_rows": lambda c: next(app.iter_books(c, 1)),
+            "checked_out_count": lambda c: c.execute(
+                "SELECT COUNT(*) FROM books WHERE owner_id=? AND in_library=0", (1,)).fetchone(),
+            "isbn_dedupe": lambda c: c.execute(
+                "SELECT 1 FROM books WHERE isbn=? OR isbn13=?", ("x", "9780306406157")).fetchone(),
+            "catalog_version": lambda c: app.catalog_version(c, 1),
+            "facet_counts": lambda c: app.facet_counts(c, 1),
+            "catalog_page_facet": lambda c: app.fetch_book_page(c, 1, cursor, facets=(("author", "Author 7"),)),
+            "catalog_page_facets_all_owners": lambda c: app.fetch_book_page(
+                c, None, in_library=1, facets=(("decade", "1990s"), ("publisher", "Publisher 3"))),
+            "changes": lambda c: list(app.change_events(c, 1, 1500)),
+            "changes_all_owners": lambda c: list(app.change_events(c, None, 1500)),
+            "user_page_pending": lambda c: app.fetch_user_page(c, "user", 0),
+        }
+        results, failed = {}, []
+        for name, run in hot_paths.items():
+            recorder = RecordingConnection(conn)
+            run(recorder)
+            plan = []
+            for sql, params in recorder.statements:
+                plan += [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+            ok = not any(BAD_PLAN.search(step) for step in plan)
+            results[name] = {"ok": ok, "plan": plan}
+            if not ok:
+                failed.append(name)
+    print(json.dumps({"scenario": "plans", "failed": failed, "queries": results}, indent=2))
+    if failed:
+        sys.exit(1)
+
+
+# ---------------- metrics: /metrics renders every family -----------------
+METRIC_FAMILIES = ("catalog_http_request_duration_seconds", "catalog_http_requests_total",
+                   "catalog_sql_queries_total", "catalog_login_attempts_total", "catalog_sessions")
+
+
+def bench_metrics(args):
+    # METRICS is read when app is imported
+    os.environ["CATALOG_METRICS"] = "1"
+    app = load_app(tempfile.mkdtemp(prefix="catalog-metrics-"))
+    seed_library(app, 50, 1)
+    client = app.app.test_client()
+    client.post("/login", data={"username": "owner0", "password": BENCH_PASSWORD})
+    client.get("/")
+    client.get("/api/books")
+    resp = client.get("/metrics")
+    body = resp.get_data(as_text=True)
+    missing = [name for name in METRIC_FAMILIES if f"\n{name}" not in "\n" + body]
+    ok = resp.status_code == 200 and not missing
+    print(json.dumps({"scenario": "metrics", "ok": ok, "status": resp.status_code,
+                      "missing": missing, "lines": len(body.splitlines())}, indent=2))
+    if not ok:
+        sys.exit(1)
+
+
+# ---------------- load: the Flask app under concurrent clients -----------------
+BENCH_PASSWORD = 'bench-password'
+# 1x1 JPEG; enrichment only needs something Pillow can resize
+STUB_COVER = bytes.fromhex(
+    "ffd8ffe000104a46494600010100000100010000ffdb004300080606070605080707070909080a0c140d0c0b0b0c1912130f141d1a"
+    "1f1e1d1a1c1c20242e2720222c231c1c2837292c30313434341f27393d38323c2e333432ffc0000b080001000101011100ffc4001f"
+    "0000010501010101010100000000000000000102030405060708090a0bffc400b5100002010303020403050504040000017d010203"
+    "00041105122131410613516107227114328191a1082342b1c11552d1f02433627282090a161718191a25262728292a343536373839"
+    "3a434445464748494a535455565758595a636465666768696a737475767778797a838485868788898a92939495969798999aa2a3a4"
+    "a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9fa"
+    "ffda0008010100003f00fbfcffd9")
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    scale = {'k': 1000, 'm': 1000000}.get(text[-1], 1)
+    return int(float(text.rstrip('km')) * scale)
+
+
+def make_isbn13(n):
+    body = f"979{n % 10 ** 9:09d}"
+    return body + str(-sum((3 if i % 2 else 1) * int(ch) for i, ch in enumerate(body)) % 10)
+
+
+class StubGoogleBooks(BaseHTTPRequestHandler):
+    # Stands in for googleapis.com: every ISBN resolves, covers are a fixed tiny JPEG
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        url = urlparse(self.path)
+        if url.path == '/cover.jpg':
+            body, content_type = STUB_COVER, 'image/jpeg'
+        else:
+            isbn = parse_qs(url.query).get('q', ['isbn:'])[0].split(':', 1)[-1]
+            port = self.server.server_address[1]
+            body = json.dumps({"items": [{"volumeInfo": {
+                "title": f"Stub Book {isbn}", "authors": ["Stub Author"], "publisher": "Stub Press",
+                "publishedDate": "2001", "imageLinks": {"thumbnail": f"http://127.0.0.1:{port}/cover.jpg"},
+            }}]}).encode()
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(ThreadingHTTPServer):
+    # Deep accept backlog so hundreds of concurrent lookups aren't dropped and retried
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def start_stub_server(delay=0.0):
+    server = StubServer(('127.0.0.1', 0), StubGoogleBooks)
+    server.delay = delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def seed_library(app, books, owners):
+    from werkzeug.security import generate_password_hash
+    password = generate_password_hash(BENCH_PASSWORD)
+    with app.app.app_context():
+        conn = app.get_db()
+        conn.executemany("INSERT INTO users (username, password, approved) VALUES (?, ?, 1)",
+                         ((f"owner{i}", password) for i in range(owners)))
+        owner_ids = [r[0] for r in conn.execute("SELECT id FROM users WHERE username LIKE 'owner%' ORDER BY id")]
+        conn.executemany(
+            "INSERT INTO books (title, authors, publisher, publishedDate, isbn, isbn13, owner_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((f"Title {i:07d}", f"Author {i % 997}", f"Publisher {i % 89}", str(1900 + i % 120),
+              make_isbn13(i), make_isbn13(i), owner_ids[i % owners]) for i in range(books)))
+        conn.commit()
+        conn.execute("ANALYZE")
+        sample_ids = {}
+        for owner_id in owner_ids:
+            sample_ids[owner_id] = [r[0] for r in conn.execute(
+                "SELECT id FROM books WHERE owner_id=? LIMIT 20", (owner_id,))]
+    return owner_ids, sample_ids
+
+
+def child_pids(pid):
+    pids = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                pids.extend(int(p) for p in f.read().split())
+    except OSError:
+        pass
+    return pids
+
+
+def rss_mb(pid):
+    # Resident memory of the process and its children (uvicorn workers)
+    total = 0.0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    total = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return total + sum(rss_mb(child) for child in child_pids(pid))
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.05):
+        super().__init__(daemon=True)
+        self.pid, self.interval = pid, interval
+        self.peak, self.running = 0.0, True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, rss_mb(self.pid))
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        return round(max(self.peak, rss_mb(self.pid)), 1)
+
+
+def login_client(base, username):
+    import requests
+    client = requests.Session()
+    client.post(f"{base}/login", data={"username": username, "password": BENCH_PASSWORD}, allow_redirects=False)
+    return client
+
+
+def endpoint_requests(base, owners, sample_ids, isbn_counter):
+    # name -> fn(client, username, owner_id, rnd) returning the response
+    def add_book(client, username, owner_id, rnd):
+        return client.post(f"{base}/", data={"isbn": make_isbn13(10 ** 8 + next(isbn_counter))},
+                           allow_redirects=False)
+
+    return {
+        "index": lambda client, username, owner_id, rnd: client.get(f"{base}/"),
+        "api_books": lambda client, username, owner_id, rnd: client.get(f"{base}/api/books"),
+        "search": lambda client, username, owner_id, rnd: client.get(
+            f"{base}/search", params={"q": f"Author {rnd.randint(0, 996)}"}),
+        "add_book": add_book,
+        "toggle_in_library": lambda client, username, owner_id, rnd: client.post(
+            f"{base}/toggle_in_library/{rnd.choice(sample_ids[owner_id] or [0])}"),
+        "login": lambda client, username, owner_id, rnd: client.post(
+            f"{base}/login", data={"username": username, "password": BENCH_PASSWORD}, allow_redirects=False),
+        "export_csv": lambda client, username, owner_id, rnd: client.get(f"{base}/export_csv"),
+        "export_pdf": lambda client, username, owner_id, rnd: client.get(f"{base}/export_pdf"),
+    }
+
+
+def drive_endpoint(send, clients, requests_per_client, base, owner_ids, pid):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    sampler = RssSampler(pid)
+    sampler.start()
+
+    def worker(n):
+        rnd = random.Random(n)
+        owner_id = owner_ids[n % len(owner_ids)]
+        username = f"owner{owner_ids.index(owner_id)}"
+        client = login_client(base, username)
+        local, failed = [], 0
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            try:
+                resp = send(client, username, owner_id, rnd)
+                resp.content
+                if resp.status_code >= 400:
+                    failed += 1
+            except Exception:
+                failed += 1
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    result = summarize(latencies, time.perf_counter() - start, errors[0])
+    result["peak_rss_mb"] = sampler.stop()
+    return result
+
+
+def start_app_server(workdir, stub_url, **env_overrides):
+    port_file = os.path.join(workdir, "port")
+    if os.path.exists(port_file):
+        os.remove(port_file)
+    env = dict(os.environ, GOOGLE_BOOKS_URL=stub_url, **env_overrides)
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "_serve", workdir, port_file], env=env)
+    deadline = time.time() + 60
+    while not os.path.exists(port_file):
+        if proc.poll() is not None or time.time() > deadline:
+            raise RuntimeError("app server failed to start")
+        time.sleep(0.05)
+    time.sleep(0.05)
+    with open(port_file) as f:
+        return proc, f"http://127.0.0.1:{int(f.read())}"
+
+
+def start_asgi_server(workdir, stub_url, workers, **env_overrides):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, GOOGLE_BOOKS_URL=stub_url, **env_overrides)
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "asgi:application", "--app-dir", HERE,
+                             "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers),
+                             "--log-level", "warning"], cwd=workdir, env=env)
+    deadline = time.time() + 60
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if proc.poll() is not None or time.time() > deadline:
+                raise RuntimeError("asgi server failed to start")
+            time.sleep(0.1)
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def serve_app(args):
+    # Child process: the app under werkzeug's threaded server, so the clients don't share its GIL
+    app = load_app(args.workdir)
+    import logging
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    with open(args.port_file + '.tmp', 'w') as f:
+        f.write(str(server.server_port))
+    os.replace(args.port_file + '.tmp', args.port_file)
+    server.serve_forever()
+
+
+def bench_load(args):
+    stub = start_stub_server()
+    stub_url = f"http://127.0.0.1:{stub.server_address[1]}/books/v1/volumes"
+    endpoints = args.endpoints.split(",") if args.endpoints else None
+    runs = []
+    for size in [parse_size(s) for s in args.sizes.split(",")]:
+        workdir = tempfile.mkdtemp(prefix=f"catalog-load-{size}-")
+        start = time.perf_counter()
+        seeder = subprocess.run([sys.executable, os.path.abspath(__file__), "_seed", workdir,
+                                 str(size), str(args.owners)], check=True, capture_output=True, text=True)
+        owner_ids, sample_ids = json.loads(seeder.stdout)
+        sample_ids = {int(k): v for k, v in sample_ids.items()}
+        seed_seconds = round(time.perf_counter() - start, 2)
+
+        # Every client connects from 127.0.0.1, so the per-IP login throttle would turn the
+        # login endpoint into a 429 benchmark; `bench.py login` measures the throttle itself
+        if args.server == "asgi":
+            proc, base = start_asgi_server(workdir, stub_url, args.workers, CATALOG_LOGIN_RATE_LIMIT='0')
+        else:
+            proc, base = start_app_server(workdir, stub_url, CATALOG_LOGIN_RATE_LIMIT='0')
+        try:
+            isbn_counter = itertools.count()
+            results = {}
+            for name, send in endpoint_requests(base, owner_ids, sample_ids, isbn_counter).items():
+                if endpoints and name not in endpoints:
+                    continue
+                results[name] = drive_endpoint(send, args.clients, args.requests, base, owner_ids, proc.pid)
+        finally:
+            proc.terminate()
+            proc.wait()
+        runs.append({"server": args.server, "workers": args.workers if args.server == "asgi" else 1,
+                     "books": size, "owners": args.owners, "clients": args.clients,
+                     "requests_per_client": args.requests, "seed_seconds": seed_seconds, "endpoints": results})
+
+    report = json.dumps({"scenario": "load", "runs": runs}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    print(report)
+
+
+# ---------------- login: throughput under a credential-stuffing flood -----------------
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def post_login(port, source_ip, username, password):
+    # Plain http.client so each simulated user can come from its own loopback address
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30, source_address=(source_ip, 0))
+    try:
+        body = f"username={username}&password={password}"
+        conn.request("POST", "/login", body, {"Content-Type": "application/x-www-form-urlencoded"})
+        resp = conn.getresponse()
+        resp.read()
+        if resp.status == 429:
+            return "throttled"
+        if resp.status == 302 and not resp.getheader("Location", "").endswith("/login"):
+            return "success"
+        return "rejected"
+    finally:
+        conn.close()
+
+
+def loopback(n, net):
+    return f"127.{net}.{(n >> 8) & 255}.{n & 255 or 1}"
+
+
+def run_login_phase(port, pid, seconds, clients, attackers, users):
+    # Legitimate users each log in once from their own address; attackers stuff wrong
+    # passwords for real usernames (so every unthrottled attempt costs a hash) from four addresses
+    stop = time.perf_counter() + seconds
+    legit_ids = itertools.count(1)
+    legit, legit_outcomes = [], {}
+    attack_outcomes = {}
+    lock = threading.Lock()
+
+    def legit_client():
+        local, outcomes = [], {}
+        while time.perf_counter() < stop:
+            n = next(legit_ids)
+            start = time.perf_counter()
+            outcome = post_login(port, loopback(n, 1), f"owner{n % users}", BENCH_PASSWORD)
+            local.append(time.perf_counter() - start)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        with lock:
+            legit.extend(local)
+            for k, v in outcomes.items():
+                legit_outcomes[k] = legit_outcomes.get(k, 0) + v
+
+    def attacker(i):
+        rnd = random.Random(i)
+        outcomes = {}
+        while time.perf_counter() < stop:
+            outcome = post_login(port, loopback(i % 4 + 1, 2), f"owner{rnd.randrange(users)}", "guess")
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        with lock:
+            for k, v in outcomes.items():
+                attack_outcomes[k] = attack_outcomes.get(k, 0) + v
+
+    threads = [threading.Thread(target=legit_client) for _ in range(clients)]
+    threads += [threading.Thread(target=attacker, args=(i,)) for i in range(attackers)]
+    cpu_start, start = cpu_seconds(pid), time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    result = summarize(legit, elapsed, sum(v for k, v in legit_outcomes.items() if k != "success"))
+    result["legit_outcomes"] = legit_outcomes
+    if attackers:
+        result["attack_outcomes"] = attack_outcomes
+        result["attack_per_s"] = round(sum(attack_outcomes.values()) / elapsed, 1)
+    result["server_cpu_s"] = round(cpu_seconds(pid) - cpu_start, 2)
+    return result
+
+
+def bench_login(args):
+    workdir = tempfile.mkdtemp(prefix="catalog-login-")
+    subprocess.run([sys.executable, os.path.abspath(__file__), "_seed", workdir, "0", str(args.users)],
+                   check=True, capture_output=True)
+    results = {}
+    for limited in (False, True):
+        proc, base = start_app_server(workdir, "http://127.0.0.1:9/unused",
+                                      CATALOG_LOGIN_RATE_LIMIT="1" if limited else "0")
+        port = int(base.rsplit(":", 1)[1])
+        try:
+            results["rate_limited" if limited else "unlimited"] = {
+                "normal": run_login_phase(port, proc.pid, args.seconds, args.clients, 0, args.users),
+                "under_attack": run_login_phase(port, proc.pid, args.seconds, args.clients, args.attackers,
+                                                args.users),
+            }
+        finally:
+            proc.terminate()
+            proc.wait()
+    print(json.dumps({"scenario": "login", "clients": args.clients, "attackers": args.attackers,
+                      "seconds": args.seconds, "results": results}, indent=2))
+
+
+# ---------------- enrich: draining the job queue, thread workers vs the asyncio loop -----------------
+def bench_enrich(args):
+    stub = start_stub_server(args.latency_ms / 1000)
+    stub_url = f"http://127.0.0.1:{stub.server_address[1]}/books/v1/volumes"
+    results = {}
+    for mode in ("threads", "async"):
+        workdir = tempfile.mkdtemp(prefix=f"catalog-enrich-{mode}-")
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), "_enrich", workdir, mode, str(args.jobs)],
+                               env=dict(os.environ, GOOGLE_BOOKS_URL=stub_url), check=True,
+                               capture_output=True, text=True)
+        results[mode] = json.loads(child.stdout)
+    print(json.dumps({"scenario": "enrich", "jobs": args.jobs, "upstream_latency_ms": args.latency_ms,
+                      "results": results}, indent=2))
+
+
+def enrich_app(args):
+    # Child process: queue `jobs` enrichments, start the workers and time the drain
+    app = load_app(args.workdir)
+    app.app.config['ASYNC_JOBS'] = args.mode == "async"
+    with app.app.app_context():
+        conn = app.get_db()
+        owner_id = conn.execute("SELECT id FROM users WHERE username='admin'").fetchone()[0]
+        with conn:
+            for i in range(args.jobs):
+                isbn = make_isbn13(i)
+                cur = conn.execute("INSERT INTO books (title, authors, publisher, publishedDate, isbn, isbn13, owner_id) "
+                                   "VALUES (?, '', '', '', ?, ?, ?)", (isbn, isbn, isbn, owner_id))
+                app.enqueue_job(conn, 'enrich_book', {'book_id': cur.lastrowid, 'isbn': isbn}, book_id=cur.lastrowid)
+        peak_threads = threading.active_count()
+        sampler = RssSampler(os.getpid())
+        sampler.start()
+        start = time.perf_counter()
+        app.notify_job_workers()
+        while True:
+            time.sleep(0.05)
+            peak_threads = max(peak_threads, threading.active_count())
+            left = conn.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'running')").fetchone()[0]
+            if not left:
+                break
+        elapsed = time.perf_counter() - start
+        states = dict(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+    print(json.dumps({"seconds": round(elapsed, 2), "jobs_per_s": round(args.jobs / elapsed, 1),
+                      "peak_threads": peak_threads, "peak_rss_mb": sampler.stop(), "states": states}))
+
+
+# ---------------- startup: import cost and time to the first response -----------------
+HEAVY_MODULES = ('fpdf', 'qrcode', 'pyotp', 'requests', 'PIL.Image')
+# Runs in a fresh interpreter per sample; prints one JSON line
+STARTUP_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app
+imported = time.perf_counter()
+client = app.configure_app().test_client()
+status = client.get("/login").status_code
+served = time.perf_counter()
+login = client.post("/login", data={"username": "admin", "password": "admin123"}).status_code
+logged_in = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "first_response_ms": (served - start) * 1000,
+                  "first_login_ms": (logged_in - start) * 1000, "statuses": [status, login],
+                  "heavy_modules_loaded": sorted(m for m in sys.argv[2].split(",") if m in sys.modules)}))
+'''
+IMPORT_PROBE = '''
+import sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+print((time.perf_counter() - start) * 1000)
+'''
+
+
+def bench_startup(args):
+    workdir = tempfile.mkdtemp(prefix="catalog-startup-")
+    # Schema setup is a deploy step now, not part of starting a process
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "flask", "--app", os.path.join(HERE, "app.py"), "init-db"],
+                   cwd=workdir, check=True, capture_output=True)
+    init_db_ms = (time.perf_counter() - start) * 1000
+
+    samples, process_ms = [], []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", STARTUP_PROBE, HERE, ",".join(HEAVY_MODULES)],
+                             cwd=workdir, check=True, capture_output=True, text=True).stdout
+        process_ms.append((time.perf_counter() - start) * 1000)
+        samples.append(json.loads(out.strip().splitlines()[-1]))
+
+    # What each deferred library would add to every process start if app.py imported it
+    deferred = {}
+    for module in HEAVY_MODULES:
+        times = [float(subprocess.run([sys.executable, "-c", IMPORT_PROBE, module], check=True,
+                                      capture_output=True, text=True).stdout) for _ in range(args.runs)]
+        deferred[module] = round(statistics.median(times), 1)
+
+    def median(key):
+        return round(statistics.median(s[key] for s in samples), 1)
+
+    print(json.dumps({
+        "scenario": "startup",
+        "runs": args.runs,
+        "init_db_cli_ms": round(init_db_ms, 1),
+        "import_ms": median("import_ms"),
+        "first_response_ms": median("first_response_ms"),
+        "first_login_ms": median("first_login_ms"),
+        "process_total_ms": round(statistics.median(process_ms), 1),
+        "statuses": samples[0]["statuses"],
+        "heavy_modules_loaded_at_first_login": samples[0]["heavy_modules_loaded"],
+        "deferred_import_ms": deferred,
+    }, indent=2))
+
+
+def seed_app(args):
+    # Child process so each library size starts from a fresh interpreter and database
+    app = load_app(args.workdir)
+    owner_ids, sample_ids = seed_library(app, args.books, args.owners)
+    print(json.dumps([owner_ids, sample_ids]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    db = sub.add_parser("db", help="connect-per-request vs pooled WAL connections")
+    db.add_argument("--threads", type=int, default=8)
+    db.add_argument("--ops", type=int, default=2000)
+    db.add_argument("--write-ratio", type=float, default=0.1)
+    db.add_argument("--books", type=int, default=5000)
+    db.set_defaults(func=bench_db)
+
+    plans = sub.add_parser("plans", help="fail if a hot query scans or sorts the books table")
+    plans.set_defaults(func=bench_plans)
+
+    metrics = sub.add_parser("metrics", help="fail unless /metrics renders with instrumentation on")
+    metrics.set_defaults(func=bench_metrics)
+
+    load = sub.add_parser("load", help="p50/p99, throughput and peak RSS per endpoint under concurrent clients")
+    load.add_argument("--sizes", default="1k", help="comma-separated library sizes, e.g. 1k,100k,1M")
+    load.add_argument("--owners", type=int, default=50)
+    load.add_argument("--clients", type=int, default=8)
+    load.add_argument("--requests", type=int, default=25, help="requests per client per endpoint")
+    load.add_argument("--endpoints", help="comma-separated subset, e.g. index,search")
+    load.add_argument("--output", help="also write the JSON report to this file")
+    load.add_argument("--server", choices=("wsgi", "asgi"), default="wsgi",
+                      help="werkzeug threaded server, or asgi.py under uvicorn")
+    load.add_argument("--workers", type=int, default=4, help="uvicorn worker processes with --server asgi")
+    load.set_defaults(func=bench_load)
+
+    login = sub.add_parser("login", help="legitimate login throughput with and without an attack flood")
+    login.add_argument("--seconds", type=float, default=5.0, help="duration of each phase")
+    login.add_argument("--clients", type=int, default=4, help="concurrent legitimate users")
+    login.add_argument("--attackers", type=int, default=16, help="concurrent attacking connections")
+    login.add_argument("--users", type=int, default=500)
+    login.set_defaults(func=bench_login)
+
+    enrich = sub.add_parser("enrich", help="time to drain queued enrichment jobs, threads vs asyncio")
+    enrich.add_argument("--jobs", type=int, default=1000)
+    enrich.add_argument("--latency-ms", type=float, default=200, help="stub Google Books response delay")
+    enrich.set_defaults(func=bench_enrich)
+
+    startup = sub.add_parser("startup", help="import cost and time to the first response in a fresh process")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    enrich_child = sub.add_parser("_enrich")
+    enrich_child.add_argument("workdir")
+    enrich_child.add_argument("mode", choices=("threads", "async"))
+    enrich_child.add_argument("jobs", type=int)
+    enrich_child.set_defaults(func=enrich_app)
+
+    serve = sub.add_parser("_serve")
+    serve.add_argument("workdir")
+    serve.add_argument("port_file")
+    serve.set_defaults(func=serve_app)
+
+    seed = sub.add_parser("_seed")
+    seed.add_argument("workdir")
+    seed.add_argument("books", type=int)
+    seed.add_argument("owners", type=int)
+    seed.set_defaults(func=seed_app)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()